@@ -2,3 +2,6 @@
 
 
 from .polytree import analyse_polytree  # NOQA
+from .contract import contract_chains, recover_beliefs  # NOQA
+from .vectorised import analyse_tree, analyse_compact  # NOQA
+from .compiled import compile_polytree, PolytreePlan  # NOQA
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""polytree inference compiled into a fixed schedule, for repeated runs on one structure"""
+
+from __future__ import print_function, division
+
+from string import ascii_letters
+
+import networkx as nx
+import numpy as np
+
+from .polytree import _hop_distances, _is_polytree
+
+
+def _contraction(n_parents):
+
+    # einsum subscripts for combining a CPT with messages from all parents (the causal support)
+    # and with messages from all but one parent, plus the diagnostic support (the message
+    # passed back to that parent), with CPT axes ordered as in analyse_polytree
+    letters = ascii_letters[:n_parents + 1]
+    parents, node = letters[:-1], letters[-1]
+
+    causal = '%s,%s->%s' % (letters, ','.join(parents), node)
+    diagnostic = ['%s,%s->%s' % (letters, ','.join([p for p in parents if p != target] + [node]),
+                                 target)
+                  for target in parents]
+
+    return causal, diagnostic
+
+
+def _logsumexp(array, axes):
+    peak = np.max(array, axis=axes, keepdims=True)
+    peak = np.where(np.isfinite(peak), peak, 0.0)
+    with np.errstate(divide='ignore'):
+        return np.log(np.exp(array - peak).sum(axis=axes)) + np.squeeze(peak, axis=axes)
+
+
+def _log_contract(log_CPT, messages, keep):
+
+    # the log of the sum of the CPT, multiplied by messages along the given axes, over
+    # all axes other than keep
+    total = log_CPT
+    for axis, message in messages:
+        shape = [1] * log_CPT.ndim
+        shape[axis] = len(message)
+        total = total + message.reshape(shape)
+
+    return _logsumexp(total, tuple(a for a in range(log_CPT.ndim) if a != keep))
+
+
+def _exp_normalise(log_values):
+    return np.exp(log_values - _logsumexp(log_values, (0,)))
+
+
+class PolytreePlan(object):
+    """a validated polytree, with its message schedule frozen
+
+    built by compile_polytree, a plan holds the node ordering, the sorted parents and children
+    of each node and the layout of each CPT contraction, so each run only does the arithmetic
+    the CPTs, priors and evidence are taken from the network when compiled, but may be
+    replaced for any single run"""
+
+    def __init__(self, tree):
+
+        if not _is_polytree(tree):
+            raise Exception('Polytree can only be used on polytrees! (no cycles when undirected)')
+
+        self.nodes   = nx.topological_sort(tree)
+        self.node_id = dict((node, i) for i, node in enumerate(self.nodes))
+
+        # edges are numbered, so that messages can be held in flat lists
+        self.edges   = tree.edges()
+        self.edge_id = dict((edge, i) for i, edge in enumerate(self.edges))
+
+        # parents are held in sorted order, as per the definition of the CPT
+        self.parents  = [[self.edge_id[p, node] for p in sorted(tree.predecessors(node))]
+                         for node in self.nodes]
+        self.children = [[self.edge_id[node, c] for c in tree.successors(node)]
+                         for node in self.nodes]
+
+        self.contractions = [_contraction(len(parents)) for parents in self.parents]
+
+        # the pivot of each connected part is its 'most ancestral' node; nodes are visited
+        # furthest from their pivot first on the inwards pass, and nearest first on the
+        # outwards pass, which gives exact beliefs wherever the evidence lies
+        distances = {}
+        for node in self.nodes:
+            if node not in distances:
+                distances.update(_hop_distances(tree, node))
+        schedule = [self.node_id[n] for d, n in sorted((distances[n], n) for n in self.nodes)]
+        pivots   = set(i for i in schedule if distances[self.nodes[i]] == 0)
+
+        self.inwards  = [i for i in reversed(schedule) if i not in pivots]
+        self.pivots   = [i for i in schedule if i in pivots]
+        self.outwards = [i for i in schedule if i not in pivots]
+
+        self.CPTs   = [np.array(tree.node[n]['CPT']) if self.parents[i] else None
+                       for i, n in enumerate(self.nodes)]
+        self.priors = [None if self.parents[i] else np.array(tree.node[n]['prior'], dtype=float)
+                       for i, n in enumerate(self.nodes)]
+        self.evidence = {}
+        for node in self.nodes:
+            if 'observation' in tree.node[node]:
+                self.evidence[node] = np.array(tree.node[node]['observation'])
+            elif 'evidence' in tree.node[node]:
+                self.evidence[node] = np.array(tree.node[node]['evidence'])
+
+        self.sizes = [len(prior) if prior is not None else CPT.shape[-1]
+                      for prior, CPT in zip(self.priors, self.CPTs)]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _inputs(self, evidence, CPTs, priors):
+
+        # CPTs, priors and evidence for a single run, as lists by node id
+        CPT = list(self.CPTs)
+        for node, value in (CPTs or {}).items():
+            CPT[self.node_id[node]] = np.asarray(value)
+
+        prior = list(self.priors)
+        for node, value in (priors or {}).items():
+            prior[self.node_id[node]] = np.asarray(value, dtype=float)
+
+        lam = [np.ones(size) for size in self.sizes]
+        for node, value in evidence.items():
+            lam[self.node_id[node]] = np.asarray(value, dtype=float)
+
+        return CPT, prior, lam
+
+    def _passes(self, CPT, prior, lam, log_space, outwards=True):
+
+        if log_space:
+            with np.errstate(divide='ignore'):
+                CPT   = [None if c is None else np.log(c) for c in CPT]
+                prior = [None if p is None else np.log(p) for p in prior]
+                lam   = [np.log(values) for values in lam]
+
+        # messages along each edge, initialised as uninformative
+        initial = np.zeros if log_space else np.ones
+        state   = {'CPT': CPT, 'prior': prior, 'lam': lam,
+                   'pi': [None] * len(self), 'rho': [None] * len(self)}
+        state['causal']     = [initial(self.sizes[self.node_id[s]]) for s, t in self.edges]
+        state['diagnostic'] = [initial(self.sizes[self.node_id[s]]) for s, t in self.edges]
+
+        step = self._step_log if log_space else self._step_linear
+
+        for i in self.inwards + self.pivots + (self.outwards if outwards else []):
+            step(i, state)
+
+        return state
+
+    def _step_linear(self, i, state):
+
+        CPT, causal, diagnostic = state['CPT'][i], state['causal'], state['diagnostic']
+        lam, pi, rho = state['lam'][i], state['pi'], state['rho']
+
+        parents  = self.parents[i]
+        children = self.children[i]
+
+        # the common case of a single parent is a plain matrix product
+        if len(parents) == 1:
+            support = np.dot(causal[parents[0]], CPT)
+        elif parents:
+            support = np.einsum(self.contractions[i][0], CPT, *[causal[e] for e in parents])
+        else:
+            support = state['prior'][i]
+        pi[i] = support / support.sum()
+
+        support = lam
+        for e in children:
+            support = support * diagnostic[e]
+        rho[i] = support / support.sum()
+
+        # each child receives the product of all but its own diagnostic message, found
+        # from the running products before and after it
+        after = [lam * pi[i]]
+        for e in reversed(children[1:]):
+            after.append(after[-1] * diagnostic[e])
+        before = np.ones(len(pi[i]))
+        for e, rest in zip(children, reversed(after)):
+            message = before * rest
+            causal[e] = message / message.sum()
+            before = before * diagnostic[e]
+
+        if len(parents) == 1:
+            message = np.dot(CPT, rho[i])
+            diagnostic[parents[0]] = message / message.sum()
+        else:
+            for e, subscripts in zip(parents, self.contractions[i][1]):
+                message = np.einsum(subscripts, CPT,
+                                    *[causal[o] for o in parents if o != e] + [rho[i]])
+                diagnostic[e] = message / message.sum()
+
+    def _step_log(self, i, state):
+
+        # as for _step_linear, but with products as sums, and CPT contractions as logsumexp
+        # nothing is normalised, so every support is an exact (log) probability
+        CPT, causal, diagnostic = state['CPT'][i], state['causal'], state['diagnostic']
+        lam, pi, rho = state['lam'][i], state['pi'], state['rho']
+
+        parents  = self.parents[i]
+        children = self.children[i]
+
+        if len(parents) == 1:
+            pi[i] = _logsumexp(CPT + causal[parents[0]][:, np.newaxis], (0,))
+        elif parents:
+            pi[i] = _log_contract(CPT, list(enumerate(causal[e] for e in parents)), len(parents))
+        else:
+            pi[i] = state['prior'][i]
+
+        rho[i] = lam
+        for e in children:
+            rho[i] = rho[i] + diagnostic[e]
+
+        after = [lam + pi[i]]
+        for e in reversed(children[1:]):
+            after.append(after[-1] + diagnostic[e])
+        before = np.zeros(len(pi[i]))
+        for e, rest in zip(children, reversed(after)):
+            causal[e] = before + rest
+            before = before + diagnostic[e]
+
+        if len(parents) == 1:
+            diagnostic[parents[0]] = _logsumexp(CPT + rho[i], (1,))
+        else:
+            for j, e in enumerate(parents):
+                others = [(k, causal[o]) for k, o in enumerate(parents) if o != e]
+                diagnostic[e] = _log_contract(CPT, others + [(len(parents), rho[i])], j)
+
+    def run(self, evidence=None, CPTs=None, priors=None, tree=None, log_space=False):
+        """calculate exact posterior probabilities following the compiled schedule
+
+        evidence is a dictionary of diagnostic evidence by node, replacing that of the
+        compiled network, whereas CPTs and priors are dictionaries by node that override
+        the compiled values for the given nodes only
+        none of these are kept beyond the run
+
+        with log_space, messages are passed as unnormalised log probabilities, which cannot
+        underflow however large the network, and the log likelihood of the evidence is exact
+
+        returns a dictionary of beliefs by node
+        if tree is given, all supports, messages and beliefs are also stored on it
+        as by analyse_polytree, such that it may then be updated lazily, along with the
+        CPTs, priors and evidence they were found from (so evidence is removed from nodes
+        without any in this run)
+        (with log_space, the log likelihood is also stored, as 'log_likelihood')"""
+
+        if evidence is None:
+            evidence = self.evidence
+
+        CPT, prior, lam = self._inputs(evidence, CPTs, priors)
+
+        state = self._passes(CPT, prior, lam, log_space)
+
+        beliefs = {}
+        for i, node in enumerate(self.nodes):
+            if log_space:
+                beliefs[node] = _exp_normalise(state['pi'][i] + state['rho'][i])
+            else:
+                belief = state['pi'][i] * state['rho'][i]
+                beliefs[node] = belief / belief.sum()
+            if np.isnan(beliefs[node]).any():
+                raise Exception('Beliefs for %s could not be found!' % (node,))
+
+        if tree is not None:
+            if log_space:
+                tree.graph['log_likelihood'] = self._log_likelihood(state['pi'], state['rho'])
+                for key in ['pi', 'rho', 'causal', 'diagnostic']:
+                    state[key] = [_exp_normalise(v) for v in state[key]]
+            self._store(tree, state, beliefs, CPT, prior, lam, evidence)
+
+        return beliefs
+
+    def _store(self, tree, state, beliefs, CPT, prior, lam, evidence):
+
+        # write a (linear) run back onto the tree, as analyse_polytree would have left it
+        for i, node in enumerate(self.nodes):
+            tree.node[node]['causal']     = state['pi'][i]
+            tree.node[node]['diagnostic'] = state['rho'][i]
+            tree.node[node]['belief']     = beliefs[node]
+            tree.node[node].pop('observation', None)
+            # the tree must hold exactly what the messages were found from
+            if self.parents[i]:
+                tree.node[node]['CPT'] = np.array(CPT[i])
+            else:
+                tree.node[node]['prior'] = np.array(prior[i])
+            if node in evidence:
+                tree.node[node]['evidence'] = np.array(lam[i])
+            else:
+                tree.node[node].pop('evidence', None)
+        for e, (s, t) in enumerate(self.edges):
+            tree.edge[s][t]['causal']     = state['causal'][e]
+            tree.edge[s][t]['diagnostic'] = state['diagnostic'][e]
+        tree.graph['initialised'] = True
+
+    def _log_likelihood(self, pi, rho):
+        # the evidence within each connected part is independent of that in all others
+        return sum(_logsumexp(pi[i] + rho[i], (0,)) for i in self.pivots)
+
+    def log_likelihood(self, evidence=None, CPTs=None, priors=None):
+        """the exact log probability of the evidence, given the CPTs and priors
+
+        arguments are as for run, but only the inwards pass is needed"""
+
+        if evidence is None:
+            evidence = self.evidence
+
+        CPT, prior, lam = self._inputs(evidence, CPTs, priors)
+
+        state = self._passes(CPT, prior, lam, True, outwards=False)
+
+        return self._log_likelihood(state['pi'], state['rho'])
+
+
+def compile_polytree(tree):
+    """validate a polytree once, and freeze the schedule used to pass messages through it
+
+    returns a PolytreePlan, whose run method gives the same beliefs as analyse_polytree
+    and may be called repeatedly, with new CPTs, priors or evidence, as long as the
+    structure of the network is unchanged"""
+
+    return PolytreePlan(tree)
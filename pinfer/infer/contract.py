@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""contraction of unary chains within tree-shaped networks, to speed up inference"""
+
+from __future__ import print_function, division
+
+from functools import reduce
+
+import numpy as np
+
+
+def _contractible(tree, node):
+
+    # a node can be contracted if it only passes messages straight through
+    # ie. it has a single parent and a single child, with no evidence of its own
+    if len(tree.pred[node]) != 1 or len(tree.succ[node]) != 1:
+        return False
+    if 'observation' in tree.node[node] or 'evidence' in tree.node[node]:
+        return False
+
+    # the child must also have a single parent, so both CPTs are simple 2D matrices
+    child = list(tree.succ[node])[0]
+    return len(tree.pred[child]) == 1
+
+
+def contract_chains(tree):
+    """contract chains of pass-through nodes into single edges
+
+    every node with a single parent and a single child (and no evidence) is removed,
+    with the CPT of the node below the chain replaced by the product of the CPTs along it
+
+    returns the contracted network (a copy), along with a dictionary mapping the node below
+    each chain to the contracted nodes (from the top) and the original CPTs of the chain"""
+
+    contracted = tree.copy()
+    contracted.graph.pop('initialised', None)
+
+    chains = {}
+    for node in tree.nodes():
+
+        if _contractible(tree, node) or not tree.pred[node]:
+            continue
+
+        interior = []
+        parent = list(tree.pred[node])[0]
+        while _contractible(tree, parent):
+            interior.append(parent)
+            parent = list(tree.pred[parent])[0]
+
+        if not interior:
+            continue
+
+        interior = interior[::-1]
+
+        CPTs = [np.array(tree.node[n]['CPT']) for n in interior + [node]]
+
+        chains[node] = {'interior': interior, 'CPTs': CPTs}
+
+        # the probability of each state of the node, given the state at the top of the chain
+        # is the product of the conditional probabilities along it
+        edge  = {'edge_type': 'interaction'}
+        pairs = list(zip([parent] + interior, interior + [node]))
+        if all('evol_dist' in tree.edge[s][t] for s, t in pairs):
+            edge['evol_dist'] = sum(tree.edge[s][t]['evol_dist'] for s, t in pairs)
+
+        contracted.remove_nodes_from(interior)
+        contracted.add_edge(parent, node, **edge)
+        contracted.node[node]['CPT'] = reduce(np.dot, CPTs)
+
+    return contracted, chains
+
+
+def recover_beliefs(tree, contracted, chains):
+    """copy the beliefs from an analysed contracted network back to the original network
+
+    the beliefs of the contracted nodes are recovered from the final messages along each
+    contracted edge, combined with the CPTs along the chain"""
+
+    for node in contracted.nodes():
+        if 'belief' in contracted.node[node]:
+            tree.node[node]['belief'] = contracted.node[node]['belief']
+
+    for node, chain in chains.items():
+
+        parent = list(contracted.pred[node])[0]
+
+        CPTs = chain['CPTs']
+
+        # causal support flows down the chain, and diagnostic support flows up it
+        causal = [contracted.edge[parent][node]['causal']]
+        for CPT in CPTs[:-1]:
+            causal.append(np.dot(causal[-1], CPT))
+
+        diagnostic = [contracted.node[node]['diagnostic']]
+        for CPT in CPTs[:0:-1]:
+            diagnostic.append(np.dot(CPT, diagnostic[-1]))
+        diagnostic = diagnostic[::-1]
+
+        for n, pi, lam in zip(chain['interior'], causal[1:], diagnostic[:-1]):
+            tree.node[n]['belief'] = (pi * lam) / sum(pi * lam)
+
+    return tree
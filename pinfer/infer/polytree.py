@@ -6,7 +6,9 @@ from __future__ import print_function, division
 import sys
 import networkx as nx
 import numpy as np
+from collections import deque
 from copy import deepcopy
+from itertools import chain
 
 
 def _initialise_polytree(tree):
@@ -137,7 +139,113 @@ def _update_node(tree, node, debug_message=''):
     return
 
 
-def analyse_polytree(tree, pivot_node=None, verbose=False):
+def _is_polytree(tree):
+    # a network is free of (undirected) cycles when each part has one edge fewer than its nodes
+    return tree.number_of_edges() == len(tree) - nx.number_weakly_connected_components(tree)
+
+
+def _neighbours(tree, node):
+    return chain(tree.pred[node], tree.succ[node])
+
+
+def _steiner_nodes(tree, terminals):
+    """all nodes on the (undirected) paths between any pair of terminals
+
+    found in a single traversal, by repeatedly pruning leaves that aren't terminals"""
+
+    terminals = set(terminals)
+
+    degree  = {n: len(tree.pred[n]) + len(tree.succ[n]) for n in tree.nodes()}
+    removed = set()
+    leaves  = deque(n for n in tree.nodes() if degree[n] <= 1 and n not in terminals)
+    while leaves:
+        node = leaves.popleft()
+        removed.add(node)
+        for other in _neighbours(tree, node):
+            if other not in removed:
+                degree[other] -= 1
+                if degree[other] == 1 and other not in terminals:
+                    leaves.append(other)
+
+    return set(n for n in tree.nodes() if n not in removed)
+
+
+def _hop_distances(tree, source):
+    """number of (undirected) edges from source to every node, by a single breadth first search"""
+
+    distances = {source: 0}
+    queue = deque([source])
+    while queue:
+        node = queue.popleft()
+        for other in _neighbours(tree, node):
+            if other not in distances:
+                distances[other] = distances[node] + 1
+                queue.append(other)
+
+    return distances
+
+
+def _message(tree, source, target):
+    # the message passed from source to a neighbouring target
+    if target in tree.succ[source]:
+        return tree.edge[source][target]['causal']
+    return tree.edge[target][source]['diagnostic']
+
+
+def _path_to(distances, tree, node):
+    """all nodes on the path from node back to the source of the distances (bar the source)"""
+
+    path = []
+    while distances[node] > 0:
+        path.append(node)
+        node = next(n for n in _neighbours(tree, node) if distances.get(n) == distances[node] - 1)
+    return path
+
+
+def _propagate(tree, pivot_node, change_set, distances, tolerance, query):
+
+    # an outwards pass that only visits nodes whose incoming messages have changed
+    # a node is visited if it is in the change_set, if it neighbours the change_set (whose
+    # messages were already rewritten on the first pass), or if the message sent to it has
+    # changed by more than the tolerance; with query nodes, only those nodes on the paths from
+    # the pivot to the query nodes are visited, with any others that should be visited left
+    # pending
+    if query is not None:
+        allowed = set(chain.from_iterable(_path_to(distances, tree, n) for n in query))
+
+    pending = set(tree.graph.get('pending', ()))
+    pending.discard(pivot_node)
+
+    visited = 0
+    queue = deque([pivot_node])
+    while queue:
+        node = queue.popleft()
+
+        outwards = [n for n in _neighbours(tree, node) if distances[n] > distances[node]]
+        previous = [_message(tree, node, n) for n in outwards]
+
+        _update_node(tree, node, debug_message='second pass')
+        visited += 1
+
+        touched = node == pivot_node or node in change_set
+        for other, before in zip(outwards, previous):
+            if not touched and (np.abs(_message(tree, node, other) - before).max() <= tolerance):
+                continue
+            if query is not None and other not in allowed:
+                pending.add(other)
+                continue
+            pending.discard(other)
+            queue.append(other)
+
+    # kept as a (sorted) list, so the graph attributes can still be saved as they are
+    tree.graph.pop('pending', None)
+    if pending:
+        tree.graph['pending'] = sorted(pending)
+
+    return visited
+
+
+def analyse_polytree(tree, pivot_node=None, verbose=False, tolerance=None, query=None):
     """
     Use the message passing algorithm from Pearl 1982 to calculate
     exact posterior probabilities
@@ -149,13 +257,18 @@ def analyse_polytree(tree, pivot_node=None, verbose=False):
         [a,g,h] = sorted(parents)
         CPT axis 0->a, 1->g, 2->h
         CPT.shape = (2,2,2,2) ie. len of parents + 1
+
+    once a tree is initialised, new evidence may be pushed out incrementally
+    with a tolerance, the outwards pass only continues past a node while the messages
+    it sends change by more than the tolerance (so a tolerance of 0. is still exact)
+    with query nodes, the outwards pass only visits nodes on the way to the query nodes
+    nodes that are left behind are recorded in tree.graph['pending'], and are brought
+    up to date by later calls as needed
     """
 
-    if nx.cycle_basis(tree.to_undirected()):
+    if not _is_polytree(tree):
         raise Exception('Polytree can only be used on polytrees! (no cycles when undirected)')
 
-    from itertools import combinations
-
     ##########
     # if necessary we initialise causal and diagnostic support values in the tree
     ##########
@@ -177,31 +290,28 @@ def analyse_polytree(tree, pivot_node=None, verbose=False):
     ##########
     # find set of all nodes that have an observation
     changed = [n for n in tree.nodes() if 'observation' in tree.node[n]]
+    # nodes left behind by an earlier incremental pass must also be brought up to date
+    changed.extend(n for n in tree.graph.get('pending', ()) if n not in changed)
     # find all nodes found in all paths between all pairs of nodes
     if len(changed) == 0:
         if verbose:
             print('No new observations found...')
         return tree
 
-    if pivot_node not in tree.nodes():
+    if pivot_node not in tree:
         if verbose:
             print('Finding pivot node...')
             sys.stdout.flush()
-        change_set = set()
-        for a, b in combinations(changed, 2):
-            change_set.update(nx.shortest_path(tree.to_undirected(), a, b))
-        if not change_set:
-            change_set = set(changed)
+        # all nodes found on the paths between the changed nodes form the change_set
+        change_set = _steiner_nodes(tree, changed)
         # choice of pivot node is largely arbitrary, so we choose the 'most ancestral' node
         pivot_node = [n for n in nx.topological_sort(tree) if n in change_set][0]
         # we don't need to address the pivot on the first pass, so remove from change_set
         change_set.remove(pivot_node)
         # we build an ordered list of all nodes, furthest from pivot_node first
-        ordered_nodes = []
-        for node in tree.nodes():
-            dist = nx.shortest_path_length(tree.to_undirected(), pivot_node, node)
-            ordered_nodes.append((dist, node))
-        ordered_nodes = [n for d, n in sorted(ordered_nodes)]
+        distances = _hop_distances(tree, pivot_node)
+        ordered_nodes = [n for d, n in sorted((distances.get(n, float('inf')), n)
+                                              for n in tree.nodes())]
         if verbose:
             print('...Pivot found!')
             sys.stdout.flush()
@@ -209,6 +319,7 @@ def analyse_polytree(tree, pivot_node=None, verbose=False):
         ordered_nodes = nx.topological_sort(tree)
         change_set = set(tree.nodes())
         change_set.remove(pivot_node)
+        distances = None
 
     ##########
     # first pass - inwards
@@ -228,8 +339,17 @@ def analyse_polytree(tree, pivot_node=None, verbose=False):
     if verbose:
         print('Second pass...')
         sys.stdout.flush()
-    for node in ordered_nodes:
-        _update_node(tree, node, debug_message='second pass')
+    if tolerance is None and query is None:
+        for node in ordered_nodes:
+            _update_node(tree, node, debug_message='second pass')
+        tree.graph.pop('pending', None)
+    else:
+        if distances is None:
+            distances = _hop_distances(tree, pivot_node)
+        visited = _propagate(tree, pivot_node, change_set, distances,
+                             tolerance or 0.0, query)
+        if verbose:
+            print('...%d of %d nodes updated' % (visited, len(tree)))
 
     # finally, we can strip the 'observation' property from all nodes
     # since this evidence has now been incorporated
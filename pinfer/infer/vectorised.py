@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""belief propagation over trees, with all messages held in arrays"""
+
+from __future__ import print_function, division
+
+import numpy as np
+
+from ..itree.index import TreeIndex
+
+
+def _normalise(array):
+    return array / array.sum(axis=1)[:, np.newaxis]
+
+
+def _sibling_products(parent, messages):
+
+    # for every node, the products of the messages from its siblings before and after it
+    # these are found rank by rank (ie. all first children at once, then all second...)
+    # rather than by dividing out each message, since messages may hold zeros
+    n = len(parent)
+
+    # siblings are ranked in order of id, within the children of each parent
+    children = np.flatnonzero(parent >= 0)
+    children = children[np.argsort(parent[children], kind='mergesort')]
+    rank = np.zeros(n, dtype=int)
+    rank[children] = (np.arange(len(children)) -
+                      np.searchsorted(parent[children], parent[children]))
+
+    has_parent = parent >= 0
+    by_rank = [np.flatnonzero(has_parent & (rank == r)) for r in range(rank.max() + 1)]
+
+    before = np.ones((n, 2))
+    after  = np.ones((n, 2))
+    for ranks, product in [(by_rank, before), (by_rank[::-1], after)]:
+        running = np.ones((n, 2))
+        for nodes in ranks:
+            product[nodes] = running[parent[nodes]]
+            running[parent[nodes]] *= messages[nodes]
+
+    return before * after
+
+
+def _inward(parent, CPT, evidence, levels):
+
+    # diagnostic support is gathered from the leaves up, a level at a time
+    # returns the diagnostic support of every node, and the message each sends to its parent
+    diagnostic = evidence.copy()
+    upward     = np.ones((len(parent), 2))
+    for nodes in reversed(levels[1:]):
+        diagnostic[nodes] = _normalise(diagnostic[nodes])
+        upward[nodes]     = _normalise(np.einsum('ipc,ic->ip', CPT[nodes], diagnostic[nodes]))
+        np.multiply.at(diagnostic, parent[nodes], upward[nodes])
+    diagnostic[levels[0]] = _normalise(diagnostic[levels[0]])
+
+    return diagnostic, upward
+
+
+def _outward(parent, CPT, prior, evidence, levels, upward):
+
+    # causal support is passed down from the roots, a level at a time
+    # returns the causal support of every node, and the message each receives from its parent
+    siblings = _sibling_products(parent, upward)
+
+    causal   = np.ones((len(parent), 2))
+    causal[levels[0]] = _normalise(np.ones((len(levels[0]), 2)) * prior)
+    downward = np.ones((len(parent), 2))
+    for nodes in levels[1:]:
+        parents = parent[nodes]
+        downward[nodes] = _normalise(causal[parents] * evidence[parents] * siblings[nodes])
+        causal[nodes]   = _normalise(np.einsum('ip,ipc->ic', downward[nodes], CPT[nodes]))
+
+    return causal, downward
+
+
+def analyse_tree(tree, verbose=False):
+    """calculate exact posterior probabilities for a tree-shaped network of two-state nodes
+
+    gives the same beliefs as analyse_polytree, but with every message held within arrays
+    of shape (n_nodes, 2) (indexed by the node at the bottom of each edge), and each pass
+    handling all of the nodes at the same depth at once, as array operations
+
+    all nodes must have at most a single parent, with the root given a prior,
+    and all other nodes a (2, 2) CPT"""
+
+    index = TreeIndex(tree)
+
+    n = len(index)
+
+    if any(np.shape(tree.node[node]['CPT']) != (2, 2) for node in index.nodes[1:]):
+        raise Exception('The vectorised engine can only be used for two-state nodes!')
+
+    CPT = np.ones((n, 2, 2))
+    CPT[1:] = [tree.node[node]['CPT'] for node in index.nodes[1:]]
+
+    # the 'observation' property sets the diagnostic evidence, exactly as in analyse_polytree
+    for node in index.nodes:
+        if 'observation' in tree.node[node]:
+            tree.node[node]['evidence'] = np.array(tree.node[node].pop('observation'))
+
+    evidence = np.array([tree.node[node].get('evidence', np.ones(2)) for node in index.nodes],
+                        dtype=float)
+
+    levels = [np.flatnonzero(index.depth == d) for d in range(index.depth.max() + 1)]
+
+    prior = np.array(tree.node[index.root]['prior'], dtype=float)
+
+    if verbose:
+        print('First pass...')
+    diagnostic, upward = _inward(index.parent, CPT, evidence, levels)
+
+    if verbose:
+        print('Second pass...')
+    causal, downward = _outward(index.parent, CPT, prior, evidence, levels, upward)
+
+    belief = _normalise(causal * diagnostic)
+
+    ##########
+    # finally, the results are stored on the network, as by analyse_polytree
+    ##########
+    for i, node in enumerate(index.nodes):
+        tree.node[node]['causal']     = causal[i]
+        tree.node[node]['diagnostic'] = diagnostic[i]
+        tree.node[node]['belief']     = belief[i]
+        if index.parent[i] >= 0:
+            edge = tree.edge[index.nodes[index.parent[i]]][node]
+            edge['causal']     = downward[i]
+            edge['diagnostic'] = upward[i]
+
+    tree.graph['initialised'] = True
+
+    if verbose:
+        print('Complete!')
+
+    return tree
+
+
+def analyse_compact(iTree, CPT, prior, evidence=None):
+    """calculate exact posterior probabilities for a CompactITree, entirely within arrays
+
+    CPT is an array of shape (n_inodes, 2, 2), indexed by inode id (the CPT of the root is
+    ignored), prior is the prior of the root, and evidence is an optional array of shape
+    (n_inodes, 2), with rows of ones where there is no evidence
+
+    returns the beliefs, as an array of shape (n_inodes, 2)"""
+
+    n = len(iTree)
+
+    CPT = np.asarray(CPT, dtype=float)
+    if CPT.shape != (n, 2, 2):
+        raise Exception('CPT must be of shape (%d, 2, 2)!' % n)
+
+    if evidence is None:
+        evidence = np.ones((n, 2))
+    evidence = np.asarray(evidence, dtype=float)
+    if evidence.shape != (n, 2):
+        raise Exception('evidence must be of shape (%d, 2)!' % n)
+
+    levels = iTree.levels()
+
+    diagnostic, upward = _inward(iTree.parent, CPT, evidence, levels)
+    causal, downward   = _outward(iTree.parent, CPT, np.asarray(prior, dtype=float), evidence,
+                                  levels, upward)
+
+    return _normalise(causal * diagnostic)
@@ -1,36 +1,270 @@
 # -*- coding: utf-8 -*-
 """module docstring here"""
 
+import bz2
+import gzip
+import json
+import os
 import re
+import warnings
+from glob import glob
+from multiprocessing import Pool
 
 import networkx as nx
+import numpy as np
 
-from Bio.Phylo import read, to_networkx
+from .itree.compact import CompactITree
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+
+# tokens of the newick format, as recognised by Bio.Phylo
+_newick_tokenizer = re.compile('|'.join([
+    r"\(",
+    r"\)",
+    r"[^\s\(\)\[\]\'\:\;\,]+",
+    r"\:\ ?[+-]?[0-9]*\.?[0-9]+([eE][+-]?[0-9]+)?",
+    r"\,",
+    r"\[(\\.|[^\]])*\]",
+    r"\'(\\.|[^\'])*\'",
+    r"\;",
+]))
+
+
+def _open_text(filename):
+
+    # compressed files are recognised by their leading bytes, rather than their extension
+    with open(filename, 'rb') as f:
+        magic = f.read(3)
+
+    if magic[:2] == b'\x1f\x8b':
+        f = gzip.open(filename, 'rb')
+    elif magic == b'BZh':
+        f = bz2.BZ2File(filename, 'rb')
+    else:
+        f = open(filename, 'rb')
+
+    with f:
+        return f.read().decode('utf-8')
+
+
+def _is_number(text):
+    try:
+        float(text)
+    except ValueError:
+        return False
+    return True
+
+
+class _NewickNodes(object):
+
+    # every node is recorded with its parent, name, branch length and comment
+    # nodes are created as they are encountered (ie. in pre-order), as in Bio.Phylo
+
+    def __init__(self):
+        self.parents  = [None]
+        self.names    = [None]
+        self.lengths  = [None]
+        self.comments = [None]
+        self.current  = 0
+        self.depth    = 0
+
+    def new_node(self, parent):
+        self.parents.append(parent)
+        self.names.append(None)
+        self.lengths.append(None)
+        self.comments.append(None)
+        self.current = len(self.parents) - 1
+
+    def open_clade(self):
+        self.new_node(self.current)
+        self.depth += 1
+
+    def next_sibling(self):
+        if self.parents[self.current] is None:
+            raise Exception('Newick tree must be enclosed in parentheses!')
+        self.new_node(self.parents[self.current])
+
+    def close_clade(self):
+        if self.parents[self.current] is None:
+            raise Exception('Parenthesis mismatch.')
+        self.current = self.parents[self.current]
+        self.depth  -= 1
+
+    def annotate(self, token):
+        # labels, comments and branch lengths all apply to the current node
+        current = self.current
+        if token.startswith("'"):
+            # quoted label, where consecutive quoted labels are escaped quotes
+            name = self.names[current]
+            self.names[current] = (name + token[:-1]) if name else token[1:-1]
+        elif token.startswith('['):
+            self.comments[current] = token[1:-1]
+        elif token.startswith(':'):
+            self.lengths[current] = float(token[1:])
+        else:
+            self.names[current] = token
+
+
+def _parse_newick(text):
+
+    nodes = _NewickNodes()
+
+    structure = {'(': nodes.open_clade, ',': nodes.next_sibling, ')': nodes.close_clade}
+
+    for match in _newick_tokenizer.finditer(text.strip()):
+        token = match.group()
+        if token == ';':
+            break
+        elif token in structure:
+            structure[token]()
+        else:
+            nodes.annotate(token)
+
+    if nodes.depth != 0:
+        raise Exception('Parenthesis mismatch.')
+
+    # numeric labels of internal nodes are support values, rather than names
+    for node in set(p for p in nodes.parents if p is not None):
+        if nodes.names[node] and _is_number(nodes.names[node]):
+            nodes.names[node] = None
+
+    return nodes.parents, nodes.names, nodes.lengths, nodes.comments
+
+
+def _gene_name(node, name, root):
+
+    # follow convention by naming the root node 'X0', and prefix lost genes with the
+    # number of their node, so all nodes have unique names
+    if root:
+        return 'X0'
+    if 'lost' in name.lower():
+        return node + name
+    return name
 
 
 def load_notung_nhx(filename):
     """load reconciled gene tree from NHX formatted file
 
+    returns networkx graph object
+    strips information from the comment field and converts into node properties
+    the file may be compressed with gzip or bzip2"""
+
+    parents, names, lengths, comments = _parse_newick(_open_text(filename))
+
+    graph = nx.DiGraph()
+    keys  = []
+
+    for node, (name, comment) in enumerate(zip(names, comments)):
+
+        # long names are truncated, and missing names replaced, exactly as by Bio.Phylo
+        if not name:
+            name = 'Clade'
+        elif len(name) > 40:
+            name = name[:37] + '...'
+
+        # nodes are created under their final names, in pre-order (the root is node 0)
+        properties = {'name': _gene_name(str(node), name, node == 0)}
+        for match in re.findall(r'[^:]*\=[^:]*', comment or ''):
+            properties[match.split('=')[0]] = match.split('=')[1]
+
+        graph.add_node(properties['name'], **properties)
+        keys.append(properties['name'])
+
+    # edges are added grouped by parent, in the same order as from a Bio.Phylo tree
+    children = [[] for _ in parents]
+    for node, parent in enumerate(parents):
+        if parent is not None:
+            children[parent].append(node)
+
+    for parent in range(len(parents)):
+        for child in children[parent]:
+            graph.add_edge(keys[parent], keys[child], distance=lengths[child] or 0.0)
+
+    return graph
+
+
+def _family_id(filename):
+    # the family is named by the file, without its extension (nor any compression suffix)
+    # such that versioned names (eg. fam.1.ntg and fam.2.ntg) are kept apart
+    name = os.path.basename(filename)
+    for suffix in ['.gz', '.bz2']:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return os.path.splitext(name)[0]
+
+
+def _load_family(filename):
+    try:
+        return _family_id(filename), load_notung_nhx(filename), None
+    except Exception as e:
+        return _family_id(filename), None, '%s: %s' % (type(e).__name__, e)
+
+
+def iter_notung_nhx(path, workers=None, failures=None):
+    """load every reconciled gene tree within a directory (or matching a glob pattern)
+
+    generates (family_id, gTree) for each file, where the family_id is the file name
+    without its extension (or compression suffix), and the files are parsed across a
+    process pool if workers is given (in which case they are generated as they complete,
+    rather than in order of file name)
+    files that can't be parsed are skipped, with the errors recorded in the failures
+    dictionary (by family_id) if given, or otherwise reported as warnings"""
+
+    if os.path.isdir(path):
+        path = os.path.join(path, '*')
+
+    filenames = sorted(f for f in glob(path) if os.path.isfile(f))
+
+    pool = Pool(workers) if workers else None
+    try:
+        if pool is None:
+            results = (_load_family(f) for f in filenames)
+        else:
+            results = pool.imap_unordered(_load_family, filenames)
+
+        for family_id, gTree, error in results:
+            if error is None:
+                yield family_id, gTree
+            elif failures is not None:
+                failures[family_id] = error
+            else:
+                warnings.warn('Failed to load %s (%s)' % (family_id, error))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def original_load_notung_nhx(filename):
+    """load reconciled gene tree from NHX formatted file, by way of Bio.Phylo
+
     returns networkx graph object
     strips information from the comment field and converts into node properties"""
 
+    from Bio.Phylo import read, to_networkx
+
     with open(filename, 'r') as f:
         tree = read(f, format='newick')
 
     tree.rooted = True
 
+    root = tree.root
     tree = to_networkx(tree)
 
     node_translator = {}
     for node in tree.nodes():
-        node_translator[node] = str(len(node_translator))
+        node_translator[node] = _gene_name(str(len(node_translator)), str(node), node is root)
 
     graph = nx.DiGraph()
 
     for node in tree.nodes():
         new_node = node_translator[node]
 
-        properties = {'name': str(node)}
+        properties = {'name': new_node}
         for match in re.findall(r'[^:]*\=[^:]*', node.comment):
             properties[match.split('=')[0]] = match.split('=')[1]
 
@@ -46,17 +280,204 @@ def load_notung_nhx(filename):
     for s, t in graph.edges():
         graph.edge[s][t].pop('weight')
 
-    # follow convention by renaming the root node to 'X0'
-    root                     = nx.topological_sort(graph)[0]
-    graph.node[root]['name'] = 'X0'
+    return graph
+
 
-    # rename lost genes, so all nodes have unique names
-    for n in [n for n in graph.nodes() if 'lost' in graph.node[n]['name'].lower()]:
-        graph.node[n]['name'] = n + graph.node[n]['name']
+def _encode_column(values, name):
 
-    # build dictionary to replace node objects with the name of each node
-    new_node_names = {n: graph.node[n]['name'] for n in graph.nodes()}
+    # strings are interned as integer codes into a table of names, and numbers are stored
+    # as plain arrays, where missing values are given as -1 (codes) or nan (numbers)
+    present = [v for v in values if v is not None]
 
-    nx.relabel_nodes(graph, new_node_names, copy=False)
+    if all(isinstance(v, string_types) for v in present):
+        table = sorted(set(present))
+        code  = {v: i for i, v in enumerate(table)}
+        return 'string', {'': np.array([code.get(v, -1) for v in values], dtype=np.int32),
+                          '.names': np.array(table, dtype='U')}
 
-    return graph
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+        if len(present) == len(values) and all(isinstance(v, int) for v in present):
+            return 'int', {'': np.array(values, dtype=np.int64)}
+        return 'float', {'': np.array([np.nan if v is None else v for v in values],
+                                      dtype=float)}
+
+    raise Exception('%s must only hold strings or numbers to be saved!' % name)
+
+
+def _decode_column(kind, arrays):
+
+    if kind == 'string':
+        names = arrays['.names'].tolist()
+        return [names[c] if c >= 0 else None for c in arrays[''].tolist()]
+
+    values = arrays[''].tolist()
+    if kind == 'float':
+        return [None if v != v else v for v in values]
+    return values
+
+
+def _save_columns(path, kind, graph, columns, attributes):
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    for name, array in columns.items():
+        np.save(os.path.join(path, name + '.npy'), array)
+
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'kind': kind, 'graph': graph, 'columns': sorted(columns),
+                   'attributes': attributes}, f, indent=1, sort_keys=True)
+
+
+def _load_columns(path, kind, mmap):
+
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+
+    if meta['kind'] != kind:
+        raise Exception('%s holds a %s, not a %s!' % (path, meta['kind'], kind))
+
+    # arrays are mapped directly from disk, such that nothing is read until needed
+    columns = {name: np.load(os.path.join(path, name + '.npy'),
+                             mmap_mode='r' if mmap else None)
+               for name in meta['columns']}
+
+    return meta, columns
+
+
+def save_gene_tree(gTree, path):
+    """save a gene tree as a directory of binary arrays
+
+    all nodes must be strings, and all node and edge properties strings or numbers"""
+
+    nodes = gTree.nodes()
+    if not all(isinstance(node, string_types) for node in nodes):
+        raise Exception('Gene tree nodes must be strings to be saved!')
+    node_id = {node: i for i, node in enumerate(nodes)}
+    edges = gTree.edges()
+
+    columns = {'nodes': np.array(nodes, dtype='U'),
+               'edge_source': np.array([node_id[s] for s, t in edges], dtype=np.int64),
+               'edge_target': np.array([node_id[t] for s, t in edges], dtype=np.int64)}
+
+    attributes = {}
+    for prefix, items in [('node', [gTree.node[n] for n in nodes]),
+                          ('edge', [gTree.edge[s][t] for s, t in edges])]:
+        for key in sorted(set(k for item in items for k in item)):
+            name = '%s.%s' % (prefix, key)
+            attributes[name], arrays = _encode_column([item.get(key) for item in items], name)
+            for suffix, array in arrays.items():
+                columns[name + suffix] = array
+
+    _save_columns(path, 'gene_tree', gTree.graph, columns, attributes)
+
+
+def load_gene_tree(path, mmap=True):
+    """load a gene tree saved by save_gene_tree, with exactly the same order of nodes and edges"""
+
+    meta, columns = _load_columns(path, 'gene_tree', mmap)
+
+    nodes = columns['nodes'].tolist()
+    edges = list(zip(columns['edge_source'].tolist(), columns['edge_target'].tolist()))
+
+    properties = {'node': [{} for _ in nodes], 'edge': [{} for _ in edges]}
+    for name, kind in meta['attributes'].items():
+        prefix, key = name.split('.', 1)
+        values = _decode_column(kind, {suffix: columns[name + suffix]
+                                       for suffix in ['', '.names'] if name + suffix in columns})
+        for item, value in zip(properties[prefix], values):
+            if value is not None:
+                item[key] = value
+
+    gTree = nx.DiGraph()
+    gTree.graph.update(meta['graph'])
+    for node, item in zip(nodes, properties['node']):
+        gTree.add_node(node, **item)
+    for (s, t), item in zip(edges, properties['edge']):
+        gTree.add_edge(nodes[s], nodes[t], **item)
+
+    return gTree
+
+
+_itree_arrays = ['gene_a', 'gene_b', 'species', 'parent', 'evol_dist', 't_birth', 't_death']
+
+
+def save_itree(iTree, path):
+    """save a CompactITree as a directory of binary arrays"""
+
+    columns = {name: getattr(iTree, name) for name in _itree_arrays}
+    columns['genes']         = np.array(iTree.genes, dtype='U')
+    columns['gene_names']    = np.array(iTree.gene_names, dtype='U')
+    columns['species_names'] = np.array(iTree.species_names, dtype='U')
+
+    _save_columns(path, 'itree', iTree.graph, columns, {})
+
+
+def load_itree(path, mmap=True):
+    """load a CompactITree saved by save_itree
+
+    unless mmap is False, the per-inode arrays are memory mapped (read-only) rather than read,
+    such that even a very large iTree opens instantly and can be shared between processes"""
+
+    meta, columns = _load_columns(path, 'itree', mmap)
+
+    return CompactITree(genes=columns['genes'].tolist(),
+                        gene_names=columns['gene_names'].tolist(),
+                        species_names=columns['species_names'].tolist(),
+                        graph=meta['graph'],
+                        **{name: columns[name] for name in _itree_arrays})
+
+
+def load_ppi(path, iTree=None, threshold=None, cdfs=None):
+    """load scored protein interactions from a tab-separated gene/gene/score file
+
+    lines starting with '#' give the species of the following pairs, and lines
+    starting with '/' are ignored, and the file may be compressed with gzip or bzip2
+
+    returns a dictionary of arrays, with one entry per pair: 'gene_a', 'gene_b', 'score'
+    and 'species' (None if no header preceeds the pair), along with 'evidence'
+    if threshold is given, the evidence for each pair is [0, 1] if the score exceeds it,
+    and [1, 0] otherwise
+    if cdfs is given as (cdf_absent, cdf_present), the cumulative distributions of scores
+    for absent and present interactions, the evidence for each pair is instead soft:
+    [1 - cdf_absent(score), cdf_present(score)], normalised
+    if iTree is given (as a CompactITree), 'inode' gives the id of the interaction
+    of each pair within it, or -1 where the pair has no interaction"""
+
+    text = _open_text(path)
+
+    # the file is split into blocks by the species headers, with each block then split
+    # into its columns in bulk
+    blocks = re.split(r'^#(.*)$', text, flags=re.M)
+
+    columns = []
+    species = []
+    for name, block in zip([None] + blocks[1::2], blocks[0::2]):
+        tokens = re.sub(r'^/.*$', '', block, flags=re.M).split()
+        if len(tokens) % 3:
+            raise Exception('Each pair must be given as gene, gene and score!')
+        columns.append(np.array(tokens, dtype='U').reshape(-1, 3))
+        species.extend([name.strip() if name else None] * (len(tokens) // 3))
+
+    columns = np.concatenate(columns)
+
+    ppi = {'gene_a': columns[:, 0],
+           'gene_b': columns[:, 1],
+           'score': columns[:, 2].astype(float),
+           'species': np.array(species, dtype=object)}
+
+    if threshold is not None:
+        present = ppi['score'] > threshold
+        ppi['evidence'] = np.column_stack([~present, present]).astype(float)
+    elif cdfs is not None:
+        cdf_absent, cdf_present = cdfs
+        evidence = np.column_stack([1.0 - np.asarray(cdf_absent(ppi['score']), dtype=float),
+                                    np.asarray(cdf_present(ppi['score']), dtype=float)])
+        ppi['evidence'] = evidence / evidence.sum(axis=1)[:, np.newaxis]
+
+    if iTree is not None:
+        # genes are interned once, with pairs then matched by their packed integer keys
+        ids = iTree.gene_table.lookup(np.concatenate([ppi['gene_a'], ppi['gene_b']]))
+        ppi['inode'] = iTree.find_inodes(ids[:len(ids) // 2], ids[len(ids) // 2:])
+
+    return ppi
@@ -1,20 +1,92 @@
 # -*- coding: utf-8 -*-
 
 from .initialise import initialise_iTree
-from .label import label_birth_death
-from .interact import add_all_inodes
+from .label import label_birth_death, birth_death_times, bumped_distance
+from .interact import build_inodes
+from . import interact
+from .index import TreeIndex
+from .compact import CompactITree
+from .collapse import collapse_paralogs, expand_beliefs  # NOQA
 
 
-def build_itree(gTree):
-    """function to construct interaction tree, given suitably annotated gene tree"""
+def _gene_times(gTree, species_times=None):
 
-    iTree = initialise_iTree(gTree)
+    # the gene tree is left untouched, with birth and death times computed alongside it
+    index = TreeIndex(gTree, weight=bumped_distance)
 
-    label_birth_death(iTree)
+    t_birth, t_death = birth_death_times(gTree, index, species_times)
 
-    add_all_inodes(iTree)
+    return index, t_birth, t_death
 
-    return iTree
+
+# update relies on _gene_times, so can only be imported once it is defined
+from .update import update_itree  # NOQA
+
+
+def build_itree(gTree, compact=False, workers=None, genes=None):
+    """function to construct interaction tree, given suitably annotated gene tree
+
+    if compact is set, the iTree is returned as an array-backed CompactITree
+    if workers is set, construction is split across a pool of that many processes
+    if genes is set, the iTree only holds the interactions between those genes and their
+    ancestral interactions (eg. pass all the nodes of a clade, to restrict to that clade)"""
+
+    index, t_birth, t_death = _gene_times(gTree)
+
+    iTree = build_inodes(gTree, index, t_birth=t_birth, t_death=t_death, workers=workers,
+                         genes=genes)
+    iTree.graph = dict(gTree.graph, name='iTree')
+
+    if compact:
+        return iTree
+
+    return iTree.to_networkx()
+
+
+def iter_inodes(gTree):
+    """generate the interactions of the interaction tree, given suitably annotated gene tree
+
+    yields (inode, parent, evol_dist) in topological order, without building the iTree
+    the root inode is given a parent and evol_dist of None"""
+
+    index, t_birth, t_death = _gene_times(gTree)
+
+    return interact.iter_inodes(gTree, index, t_birth=t_birth, t_death=t_death)
+
+
+# approximate bytes per inode and per edge of a networkx iTree, covering the attribute
+# dictionaries, adjacency entries and name strings (measured with tracemalloc, for gene
+# names of a typical length)
+_networkx_inode_nbytes = 545
+_networkx_edge_nbytes  = 385
+
+
+def estimate_itree(gTree, compact=False):
+    """report the size of the interaction tree, given suitably annotated gene tree
+
+    returns a dictionary for each species, with the number of inodes, of interaction edges
+    (leading into the inodes of that species) and the bytes needed to store them, as built
+    by build_itree with the same compact setting
+    the bytes are exact for a CompactITree, but only approximate for a networkx iTree
+    only the lifespans of the genes are compared, without constructing any inodes"""
+
+    index, t_birth, t_death = _gene_times(gTree)
+
+    counts = interact.count_inodes(gTree, index, t_birth=t_birth, t_death=t_death)
+
+    estimate = {}
+    for species, inodes in counts.items():
+        # every inode has a single parent, apart from the root (the root gene with itself)
+        edges = inodes - 1 if species == gTree.node[index.root]['S'] else inodes
+        if compact:
+            nbytes = inodes * CompactITree.inode_nbytes
+        else:
+            nbytes = inodes * _networkx_inode_nbytes + edges * _networkx_edge_nbytes
+        estimate[species] = {'inodes': inodes,
+                             'edges': edges,
+                             'nbytes': nbytes}
+
+    return estimate
 
 
 from .interact_original import add_all_inodes as original_add_all_inodes
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""collapsing of near-identical paralogs, to shrink interaction trees"""
+
+from __future__ import print_function, division
+
+from itertools import combinations_with_replacement, product
+
+from .index import TreeIndex
+from .utils import get_inode_name, gene_is_lost
+
+
+def collapse_paralogs(gTree, tolerance):
+    """collapse clades of near-identical paralogs into a single representative gene
+
+    a clade is collapsed when it is rooted at a duplication, lies entirely within a single
+    species, contains no lost genes, and no two of its leaves are further apart than the
+    tolerance (in terms of branch distance)
+    the representative is the first leaf of the clade, attached directly to the parent of
+    the clade, and keeps the distance from that parent
+
+    returns the collapsed gene tree (a copy), along with a dictionary mapping each
+    representative gene to the list of leaves it represents"""
+
+    index = TreeIndex(gTree)
+
+    distance = index.weight.tolist()
+    species  = [gTree.node[n]['S'] for n in index.nodes]
+
+    # for every node we find the greatest distance down to a leaf, and the greatest distance
+    # between any two of its leaves, in a single pass from the leaves upwards
+    height   = [0.0] * len(index)
+    diameter = [0.0] * len(index)
+    uniform  = [not gene_is_lost(gTree, n) for n in index.nodes]
+    for i in reversed(range(len(index))):
+        reach = sorted([distance[c] + height[c] for c in index.children[i]], reverse=True)
+        if reach:
+            height[i]   = reach[0]
+            diameter[i] = max([sum(reach[:2])] + [diameter[c] for c in index.children[i]])
+        uniform[i] = uniform[i] and all(uniform[c] and species[c] == species[i]
+                                        for c in index.children[i])
+
+    def collapsible(i):
+        return (index.children[i] and index.parent[i] >= 0 and uniform[i] and
+                gTree.node[index.nodes[i]]['D'] == 'Y' and diameter[i] <= tolerance)
+
+    collapsed = gTree.copy()
+    members   = {}
+
+    # the topmost collapsible clades are found from the root downwards
+    stack = [0]
+    while stack:
+        i = stack.pop()
+
+        if not collapsible(i):
+            stack.extend(reversed(index.children[i]))
+            continue
+
+        clade  = []
+        leaves = []
+        below  = [(i, 0.0)]
+        while below:
+            j, dist = below.pop()
+            clade.append(j)
+            if not index.children[j]:
+                leaves.append((j, dist))
+            below.extend((c, dist + distance[c]) for c in reversed(index.children[j]))
+
+        representative, dist = min(leaves)
+
+        parent = index.nodes[index.parent[i]]
+        collapsed.remove_nodes_from([index.nodes[j] for j in clade if j != representative])
+        collapsed.add_edge(parent, index.nodes[representative], distance=distance[i] + dist)
+
+        members[index.nodes[representative]] = [index.nodes[j] for j, _ in sorted(leaves)]
+
+    return collapsed, members
+
+
+def expand_beliefs(iTree, gTree, members, attribute='belief'):
+    """map beliefs of an iTree built from a collapsed gene tree back onto the original genes
+
+    gTree and members are as returned by collapse_paralogs
+    returns a dictionary from each original inode to the belief of the inode representing it,
+    such that interactions between the leaves of a single clade take the belief of the
+    self interaction of their representative"""
+
+    def get_genes(inode):
+        # inodes are named by their genes, but the gene names may themselves contain '-'
+        for i in [i for i, c in enumerate(inode) if c == '-']:
+            if inode[:i] in gTree and inode[i + 1:] in gTree:
+                return inode[:i], inode[i + 1:]
+        raise Exception('%s is not an interaction of the gene tree!' % inode)
+
+    beliefs = {}
+    for inode in iTree.nodes():
+
+        if attribute not in iTree.node[inode]:
+            continue
+
+        geneA, geneB = get_genes(inode)
+
+        if geneA == geneB:
+            pairs = combinations_with_replacement(members.get(geneA, [geneA]), 2)
+        else:
+            pairs = product(members.get(geneA, [geneA]), members.get(geneB, [geneB]))
+
+        for a, b in pairs:
+            beliefs[get_inode_name(a, b)] = iTree.node[inode][attribute]
+
+    return beliefs
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""array-backed representation of interaction trees"""
+
+from __future__ import print_function, division
+
+from copy import deepcopy
+
+import networkx as nx
+import numpy as np
+
+from .utils import get_inode_name, pack_pairs, SymbolTable
+
+
+class CompactITree(object):
+    """array-backed interaction tree
+
+    each inode is identified by an integer id, and described by the ids of its two genes
+    within an interned gene table, rather than by formatted name strings
+    all per-inode properties are numpy arrays indexed by inode id, with the parent of the
+    root inode given as -1 (and its evol_dist as nan)"""
+
+    # bytes per inode, across all the per-inode arrays
+    inode_nbytes = (3 * np.dtype(np.int32).itemsize + np.dtype(np.int64).itemsize +
+                    3 * np.dtype(float).itemsize)
+
+    def __init__(self, genes, gene_names, species_names,
+                 gene_a, gene_b, species, parent, evol_dist, t_birth, t_death, graph=None):
+
+        # interned tables, shared by all inodes
+        self.genes         = list(genes)
+        self.gene_names    = list(gene_names)
+        self.species_names = list(species_names)
+
+        # per-inode arrays
+        self.gene_a    = np.asarray(gene_a, dtype=np.int32)
+        self.gene_b    = np.asarray(gene_b, dtype=np.int32)
+        self.species   = np.asarray(species, dtype=np.int32)
+        self.parent    = np.asarray(parent, dtype=np.int64)
+        self.evol_dist = np.asarray(evol_dist, dtype=float)
+        self.t_birth   = np.asarray(t_birth, dtype=float)
+        self.t_death   = np.asarray(t_death, dtype=float)
+
+        self.graph = dict(graph) if graph else {'name': 'iTree'}
+
+        self._children = None
+        self._genes    = None
+        self._keys     = None
+
+    def __len__(self):
+        return len(self.parent)
+
+    @property
+    def nbytes(self):
+        """total size of the per-inode arrays"""
+        return sum(array.nbytes for array in [self.gene_a, self.gene_b, self.species,
+                                              self.parent, self.evol_dist,
+                                              self.t_birth, self.t_death])
+
+    @property
+    def gene_table(self):
+        """symbol table of the genes, mapping each gene to its id"""
+        if self._genes is None:
+            self._genes = SymbolTable(self.genes)
+        return self._genes
+
+    def find_inodes(self, gene_a, gene_b):
+        """ids of the interactions between arrays of gene ids (in either order)
+
+        the id is -1 for any pair without an interaction (or with an id of -1)"""
+
+        # every interaction is identified by a single integer key, packed from its gene ids
+        if self._keys is None:
+            keys = pack_pairs(self.gene_a, self.gene_b)
+            order = np.argsort(keys)
+            self._keys = (keys[order], order)
+        keys, order = self._keys
+
+        gene_a = np.asarray(gene_a, dtype=np.int64)
+        gene_b = np.asarray(gene_b, dtype=np.int64)
+
+        query = pack_pairs(gene_a, gene_b)
+        found = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+
+        return np.where((gene_a >= 0) & (gene_b >= 0) & (keys[found] == query), order[found], -1)
+
+    def inode_id(self, geneA, geneB):
+        """the id of the interaction between two genes, or -1 if they don't interact"""
+        ids = self.gene_table.lookup([geneA, geneB])
+        return int(self.find_inodes(ids[:1], ids[1:])[0])
+
+    def inode_key(self, i):
+        """the networkx node for inode id i"""
+        return get_inode_name(self.genes[self.gene_a[i]], self.genes[self.gene_b[i]])
+
+    def inode_name(self, i):
+        """the 'name' property for inode id i"""
+        return get_inode_name(self.gene_names[self.gene_a[i]],
+                              self.gene_names[self.gene_b[i]])
+
+    def inode_keys(self):
+        """the networkx nodes for all inodes, in order of id"""
+        return [self.inode_key(i) for i in range(len(self))]
+
+    def children(self):
+        """children of every inode, as offsets into an array of child ids (CSR layout)
+
+        the children of inode i are ids[offsets[i]:offsets[i + 1]], in order of id"""
+
+        if self._children is None:
+            has_parent = self.parent >= 0
+            ids        = np.flatnonzero(has_parent)
+            ids        = ids[np.argsort(self.parent[ids], kind='mergesort')]
+            counts     = np.bincount(self.parent[has_parent], minlength=len(self))
+            offsets    = np.concatenate([[0], np.cumsum(counts)])
+            self._children = (offsets, ids)
+
+        return self._children
+
+    def topological_order(self):
+        """array of all inode ids, such that every parent precedes its children"""
+
+        offsets, ids = self.children()
+
+        order = list(np.flatnonzero(self.parent < 0))
+        i = 0
+        while i < len(order):
+            order.extend(ids[offsets[order[i]]:offsets[order[i] + 1]])
+            i += 1
+
+        return np.array(order, dtype=np.int64)
+
+    def levels(self):
+        """list of arrays of inode ids at each depth, from the root(s) downwards"""
+
+        offsets, ids = self.children()
+
+        levels   = []
+        frontier = np.flatnonzero(self.parent < 0)
+        while len(frontier):
+            levels.append(frontier)
+            # all children of the frontier are gathered at once from the CSR layout
+            counts   = offsets[frontier + 1] - offsets[frontier]
+            starts   = np.repeat(offsets[frontier] - np.cumsum(counts) + counts, counts)
+            frontier = ids[starts + np.arange(counts.sum())]
+
+        return levels
+
+    def to_networkx(self, graph=None):
+        """export as a networkx DiGraph, identical to that built by build_itree
+
+        if graph is given, the inodes are added to it rather than to a new graph"""
+
+        if graph is None:
+            graph = nx.DiGraph()
+            graph.graph.update(deepcopy(self.graph))
+
+        keys = self.inode_keys()
+
+        for i, key in enumerate(keys):
+            graph.add_node(key, name=self.inode_name(i), node_type='interaction',
+                           S=self.species_names[self.species[i]])
+
+        for i in np.flatnonzero(self.parent >= 0):
+            graph.add_edge(keys[self.parent[i]], keys[i], edge_type='interaction',
+                           evol_dist=float(self.evol_dist[i]))
+
+        return graph
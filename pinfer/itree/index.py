@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""precomputed structural lookups for rooted trees"""
+
+from __future__ import print_function, division
+
+import networkx as nx
+import numpy as np
+
+
+class TreeIndex(object):
+    """structural lookups for a rooted tree (gene tree or iTree), computed once
+
+    every node is assigned an integer id following the topological order of the tree,
+    such that a parent always has a smaller id than any of its children
+    all the array attributes are indexed by these ids
+
+    weight is the edge property used for distances, or a function weight(u, v, data)"""
+
+    def __init__(self, tree, weight='distance'):
+
+        if not callable(weight):
+            attribute = weight
+
+            def weight(u, v, data):
+                return data.get(attribute, 0.0)
+
+        # node ids follow the networkx topological order, so iterating over ids
+        # visits nodes in exactly the order the rest of pinfer has always used
+        self.nodes   = nx.topological_sort(tree)
+        self.node_id = {node: i for i, node in enumerate(self.nodes)}
+
+        parent        = []
+        depth         = []
+        edge_weight   = []
+        root_distance = []
+        for i, node in enumerate(self.nodes):
+
+            predecessors = tree.predecessors(node)
+
+            if len(predecessors) > 1:
+                raise Exception('TreeIndex requires each node to have at most one parent!')
+
+            if not predecessors:
+                if i != 0:
+                    raise Exception('TreeIndex requires the tree to have a single root!')
+                parent.append(-1)
+                depth.append(0)
+                edge_weight.append(0.0)
+                root_distance.append(0.0)
+                continue
+
+            p = self.node_id[predecessors[0]]
+            parent.append(p)
+            depth.append(depth[p] + 1)
+            edge_weight.append(weight(predecessors[0], node, tree.edge[predecessors[0]][node]))
+            root_distance.append(root_distance[p] + edge_weight[-1])
+
+        self.root          = self.nodes[0] if self.nodes else None
+        self.parent        = np.array(parent, dtype=int)
+        self.depth         = np.array(depth, dtype=int)
+        self.root_distance = np.array(root_distance, dtype=float)
+
+        # the weight of the edge from the parent of each node (zero for the root)
+        self.weight = np.array(edge_weight, dtype=float)
+
+        # children retain the order of the successors within the tree
+        self.children = [[self.node_id[c] for c in tree.successors(node)]
+                         for node in self.nodes]
+
+        self._build_euler_tour()
+
+        self._sparse_table = None
+        self._jump_table   = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _build_euler_tour(self):
+
+        euler = []
+        first = np.zeros(len(self.nodes), dtype=int)
+        last  = np.zeros(len(self.nodes), dtype=int)
+
+        if not self.nodes:
+            self.euler, self.first, self.last = np.array(euler, dtype=int), first, last
+            return
+
+        # iterative depth first search, so deep trees don't hit the recursion limit
+        # each node is recorded on arrival, and again on return from each of its children
+        stack = [(0, 0)]
+        while stack:
+            node, i = stack[-1]
+            if i == 0:
+                first[node] = len(euler)
+            last[node] = len(euler)
+            euler.append(node)
+            if i < len(self.children[node]):
+                stack[-1] = (node, i + 1)
+                stack.append((self.children[node][i], 0))
+            else:
+                stack.pop()
+
+        self.euler = np.array(euler, dtype=int)
+        self.first = first
+        self.last  = last
+
+    def _get_sparse_table(self):
+
+        # the table is only built on the first LCA query, as many uses never need it
+        if self._sparse_table is None:
+
+            euler_depth = self.depth[self.euler]
+
+            m = len(self.euler)
+
+            # row k holds the position of the shallowest entry in each window of length 2**k
+            table = [np.arange(m)]
+            k = 1
+            while (1 << k) <= m:
+                previous = table[-1]
+                left     = previous[:m - (1 << k) + 1]
+                right    = previous[(1 << (k - 1)):(1 << (k - 1)) + len(left)]
+                row      = np.array(previous)
+                row[:len(left)] = np.where(euler_depth[left] <= euler_depth[right], left, right)
+                table.append(row)
+                k += 1
+
+            log2 = np.zeros(m + 1, dtype=int)
+            for i in range(2, m + 1):
+                log2[i] = log2[i // 2] + 1
+
+            self._sparse_table = (np.array(table), log2, euler_depth)
+
+        return self._sparse_table
+
+    def _get_jump_table(self):
+
+        # binary lifting table, where row k holds the 2**k-th ancestor of each node
+        # built on first use, as plain lists since it is only ever read one entry at a time
+        if self._jump_table is None:
+
+            table = [[int(p) for p in self.parent]]
+            while any(p != -1 for p in table[-1]):
+                previous = table[-1]
+                table.append([previous[p] if p != -1 else -1 for p in previous])
+
+            self._jump_table = table
+
+        return self._jump_table
+
+    def climb(self, i, keys, threshold, strict=False):
+        """id of the nearest ancestor (or self) of node id i whose key is below threshold
+
+        the keys (eg. birth times) must never increase from a node to its parent,
+        such that the ancestors can be searched by binary lifting
+        the threshold is inclusive unless strict is set, and -1 is returned if no match"""
+
+        def below(j):
+            return keys[j] < threshold if strict else keys[j] <= threshold
+
+        if below(i):
+            return i
+
+        table = self._get_jump_table()
+
+        for k in reversed(range(len(table))):
+            j = table[k][i]
+            if j != -1 and not below(j):
+                i = j
+
+        return table[0][i]
+
+    def is_ancestor(self, a, b):
+        """True if node id a is an ancestor of (or the same as) node id b
+
+        a and b may equally be arrays of node ids"""
+        return (self.first[a] <= self.first[b]) & (self.last[b] <= self.last[a])
+
+    def lca(self, a, b):
+        """id of the lowest common ancestor of node ids a and b
+
+        a and b may equally be arrays of node ids"""
+
+        table, log2, euler_depth = self._get_sparse_table()
+
+        lo = np.minimum(self.first[a], self.first[b])
+        hi = np.maximum(self.first[a], self.first[b])
+
+        k = log2[hi - lo + 1]
+
+        left  = table[k, lo]
+        right = table[k, hi - (1 << k) + 1]
+
+        return self.euler[np.where(euler_depth[left] <= euler_depth[right], left, right)]
+
+    def hops(self, a, b):
+        """number of edges on the (undirected) path between node ids a and b"""
+        return self.depth[a] + self.depth[b] - 2 * self.depth[self.lca(a, b)]
+
+    def path_length(self, a, b):
+        """total weight on the (undirected) path between node ids a and b"""
+        return (self.root_distance[a] + self.root_distance[b] -
+                2 * self.root_distance[self.lca(a, b)])
+
+    def path(self, a, b):
+        """list of node ids on the (undirected) path from a to b, inclusive"""
+
+        ancestor = self.lca(a, b)
+
+        up = [a]
+        while up[-1] != ancestor:
+            up.append(self.parent[up[-1]])
+
+        down = [b]
+        while down[-1] != ancestor:
+            down.append(self.parent[down[-1]])
+
+        return up + down[-2::-1]
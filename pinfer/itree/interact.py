@@ -3,10 +3,17 @@
 
 from __future__ import print_function, division
 
+from collections import defaultdict
+from heapq import heappush, heappop, merge
+from itertools import groupby, islice
+from multiprocessing import Pool
+
 import networkx as nx
-from networkx.exception import NetworkXNoPath
+import numpy as np
 
-from .utils import get_inode_name
+from .compact import CompactITree
+from .index import TreeIndex
+from .utils import get_inode_name, pack_pairs, SymbolTable
 from .utils import gene_is_lost
 
 
@@ -16,14 +23,14 @@ def make_new_inode(tree, geneA, geneB):
 
     inode_name = get_inode_name(tree.node[geneA]['name'], tree.node[geneB]['name'])
 
-    if inode in tree.nodes():
+    if inode in tree:
         raise Exception("Uh oh, this shouldn't be here!")
     tree.add_node(inode, name=inode_name, node_type='interaction', S=tree.node[geneA]['S'])
 
     return inode
 
 
-def add_inode_parent(tree, inode):
+def add_inode_parent(tree, inode, index=None):
 
     def walk_back_gene_pair(tree, geneA, geneB):
 
@@ -87,8 +94,11 @@ def add_inode_parent(tree, inode):
     geneA = genes[0]
     geneB = genes[-1]
 
+    # the index of the gene tree identifies the root, without sorting the whole iTree
+    root = nx.topological_sort(tree)[0] if index is None else index.root
+
     # if the genes are both the ancestral root gene, then there is no parent to find
-    if geneA == geneB == nx.topological_sort(tree)[0]:
+    if geneA == geneB == root:
         return
 
     # we continue an iterative search until the parent interaction is found
@@ -104,100 +114,478 @@ def add_inode_parent(tree, inode):
     tree.add_edge(parent_interaction, inode, edge_type='interaction')
 
 
-def add_inode_distance(tree, iparent, inode):
+class PairWalker(object):
+    """walks a pair of genes back through the gene tree, to find their parent interaction
 
-    genes = [n for n in tree.predecessors(inode) if tree.node[n]['node_type'] == 'gene']
+    genes are given as ids within the index of the gene tree, and interacts(a, b) must
+    report whether the (distinct) gene ids a and b have an interaction in the iTree"""
 
-    # the two genes may be the same if this is a self interaction
-    geneA = genes[0]
-    geneB = genes[-1]
+    def __init__(self, index, t_birth, t_death, interacts):
 
-    parents = [n for n in tree.predecessors(iparent) if tree.node[n]['node_type'] == 'gene']
+        self.index     = index
+        self.interacts = interacts
 
-    # the two parents may be the same if this is a self interaction
-    parentA = parents[0]
-    parentB = parents[-1]
+        self.t_birth = [float(t) for t in t_birth]
+        self.t_death = [float(t) for t in t_death]
+        self.parent  = [int(p) for p in index.parent]
 
-    if geneA == geneB:
-        # there is only one path between them and parentA must also equal parentB
-        assert parentA == parentB
+        # a gene is walked back in order of the birth time of its parent
+        # these never increase towards the root, so the walk can jump by binary lifting
+        self.key = [self.t_birth[p] if p != -1 else -float('inf') for p in self.parent]
 
-        tree.edge[iparent][inode]['evol_dist'] = \
-            nx.shortest_path_length(tree, parentA, geneA, weight='distance')
-        return
+        self.root = index.node_id[index.root]
+
+    def parent_pair(self, a, b):
+        """the pair of gene ids of the parent interaction, or None for the root interaction"""
+
+        parent, key, t_birth, t_death = self.parent, self.key, self.t_birth, self.t_death
+
+        # if the genes are both the ancestral root gene, then there is no parent to find
+        if a == b == self.root:
+            return None
+
+        # we continue an iterative search until the parent interaction is found
+        while True:
+
+            # if both genes have a parent, we must select the one most recently born
+            # (in the case of a tie, it's arbitrary, but always the second gene)
+            # if either gene has no parent, we *must* walk back the other one
+            if parent[a] == -1 and parent[b] == -1:
+                raise Exception("Neither has a parent?! This shouldn't be possible!")
+            if key[a] > key[b]:
+                a = parent[a]
+            else:
+                b = parent[b]
+
+            # we know that if the genes are the same, we must have the self interaction
+            if a == b or self.interacts(a, b):
+                return a, b
+
+            # if one gene died before the other was born, none of the pairs reached by walking
+            # back the older gene can interact, so we skip straight to the last of them
+            # ie. the first ancestor that would no longer be selected to walk back
+            if t_death[a] <= t_birth[b] and not self.index.is_ancestor(b, a):
+                a = self.index.climb(a, key, key[b])
+            elif t_death[b] <= t_birth[a] and not self.index.is_ancestor(a, b):
+                b = self.index.climb(b, key, key[a], strict=True)
+
+
+def evol_distances(index, geneA, geneB, parentA, parentB):
+    """evolutionary distances between interactions, given arrays of their gene ids
+
+    the distance is the total length of the gene tree paths from the parent genes to
+    the child genes, which is read from the root distances within the index of the gene tree"""
+
+    is_self = geneA == geneB
 
-    # if inode is not a self interaction, there must be two route total between
-    # all (unique) parents and all genes
-    path_lengths = []
-    for parent in set([parentA, parentB]):
-        for gene in [geneA, geneB]:
-            try:
-                path_lengths.append(nx.shortest_path_length(tree, parent, gene, weight='distance'))
-            except NetworkXNoPath:
-                pass
-
-    if len(path_lengths) != 2:
-        print(path_lengths)
+    # if inode is not a self interaction, there must be two routes in total between
+    # all (unique) parents and all genes, and there is only a route from an ancestor
+    # for a self interaction there is only one path, and parentA must also equal parentB
+    routes = [(parentA, geneA, np.ones(len(geneA), dtype=bool)),
+              (parentA, geneB, ~is_self),
+              (parentB, geneA, ~is_self & (parentA != parentB)),
+              (parentB, geneB, ~is_self & (parentA != parentB))]
+
+    assert (parentA[is_self] == parentB[is_self]).all()
+
+    n_paths   = np.zeros(len(geneA), dtype=int)
+    evol_dist = np.zeros(len(geneA))
+    for parent, gene, included in routes:
+        exists = included & index.is_ancestor(parent, gene)
+        n_paths += exists
+        evol_dist += np.where(exists, index.root_distance[gene] - index.root_distance[parent], 0.0)
+
+    if (n_paths != np.where(is_self, 1, 2)).any():
+        print(np.flatnonzero(n_paths != np.where(is_self, 1, 2)))
         raise Exception("there aren't exactly two paths!!")
 
-    # tree.edge[iparent][inode]['evol_dist'] = path_lengths
-    tree.edge[iparent][inode]['evol_dist'] = sum(path_lengths)
+    return evol_dist
 
 
-def add_all_inodes(tree):
-    """function to construct interaction tree, given suitably annotated gene tree"""
+def count_inodes(tree, index=None, t_birth=None, t_death=None):
+    """number of interactions within each species, without constructing any of them
 
-    from itertools import combinations_with_replacement
+    t_birth and t_death are as for build_inodes"""
 
-    # for an initial implementation, we go for the most conceptually simple approach
-    # efficiency be damned!
-    for (geneA, geneB) in combinations_with_replacement(tree.nodes(), 2):
+    if index is None:
+        index = TreeIndex(tree)
 
-        # if either gene is lost, no interaction
-        if gene_is_lost(tree, geneA) or gene_is_lost(tree, geneB):
-            continue
+    t_birth, t_death = _gene_times(tree, index, t_birth, t_death)
 
-        if geneA == geneB:
+    counts = {}
+    for genes in _species_genes(tree, index):
+
+        ids = [index.node_id[gene] for gene in genes if not gene_is_lost(tree, gene)]
+
+        births = np.sort([t_birth[i] for i in ids])
+        deaths = np.sort([t_death[i] for i in ids])
+
+        # exactly as in the sweep of iter_gene_pairs, each gene interacts with itself, and
+        # with every gene born before it, except those that died before (or as) it was born
+        earlier = np.arange(len(ids))
+        dead    = np.searchsorted(deaths, births, side='right')
+
+        counts[tree.node[genes[0]]['S']] = int(len(ids) + (earlier - dead).sum())
+
+    return counts
+
+
+def add_inode_distances(tree, index, edges):
+    """annotate each interaction edge with the evolutionary distance between the interactions
+
+    all edges are handled together, as array operations"""
+
+    def get_genes(inode):
+        genes = [n for n in tree.predecessors(inode) if tree.node[n]['node_type'] == 'gene']
+        # the two genes may be the same if this is a self interaction
+        return index.node_id[genes[0]], index.node_id[genes[-1]]
+
+    edges = list(edges)
+    if not edges:
+        return
 
-            inode = make_new_inode(tree, geneA, geneB)
+    geneA, geneB     = np.array([get_genes(inode) for iparent, inode in edges], dtype=int).T
+    parentA, parentB = np.array([get_genes(iparent) for iparent, inode in edges], dtype=int).T
 
-            # this new node hangs from the parent genes
-            tree.add_edge(geneA, inode, distance=0.0)
-            tree.add_edge(geneB, inode, distance=0.0)
+    evol_dist = evol_distances(index, geneA, geneB, parentA, parentB)
+
+    for (iparent, inode), distance in zip(edges, evol_dist):
+        tree.edge[iparent][inode]['evol_dist'] = float(distance)
+
+
+def add_inode_distance(tree, iparent, inode, index=None):
+
+    if index is None:
+        index = TreeIndex(tree.subgraph([n for n in tree.nodes()
+                                         if tree.node[n]['node_type'] == 'gene']))
+
+    add_inode_distances(tree, index, [(iparent, inode)])
+
+
+def _read_times(tree, genes, t_birth, t_death):
+
+    # times of each gene, read from the tree wherever they are not given
+    if t_birth is None:
+        t_birth = {n: tree.node[n]['t_birth'] for n in genes}
+    if t_death is None:
+        t_death = {n: tree.node[n]['t_death'] for n in genes}
+
+    return t_birth, t_death
+
+
+def _genes_by_species(tree, genes):
+
+    # lost genes never interact, and genes from different species never interact
+    species_genes = defaultdict(list)
+    for gene in genes:
+        if not gene_is_lost(tree, gene):
+            species_genes[tree.node[gene]['S']].append(gene)
+
+    return species_genes
+
+
+def iter_gene_pairs(tree, genes=None, t_birth=None, t_death=None):
+    """generate every pair of genes whose lifespans overlap, including self pairs
+
+    genes are grouped by species and swept in order of birth, such that each gene is
+    only ever compared against the genes of its own species still alive when it is born
+    t_birth and t_death map each gene to its times, and are read from the tree if not given"""
+
+    genes = tree.nodes() if genes is None else genes
+
+    t_birth, t_death = _read_times(tree, genes, t_birth, t_death)
+
+    for species, members in _genes_by_species(tree, genes).items():
+
+        members.sort(key=t_birth.get)
+
+        # heap of the genes currently alive, keyed on their time of death
+        alive = []
+        for i, gene in enumerate(members):
+
+            # anything that died before or at the same time as this gene was born is done
+            while alive and alive[0][0] <= t_birth[gene]:
+                heappop(alive)
+
+            yield gene, gene
+
+            # every remaining gene died after this one was born, so we need only check
+            # that this gene died after the other was born (ties in birth time)
+            for _, _, other in alive:
+                if t_death[gene] > t_birth[other]:
+                    yield other, gene
+
+            heappush(alive, (t_death[gene], i, gene))
+
+
+def _gene_times(tree, index, t_birth, t_death):
+
+    if t_birth is None:
+        t_birth = [tree.node[n]['t_birth'] for n in index.nodes]
+    if t_death is None:
+        t_death = [tree.node[n]['t_death'] for n in index.nodes]
+
+    return [float(t) for t in t_birth], [float(t) for t in t_death]
+
+
+def _lifespans_overlap(tree, index, t_birth, t_death):
+
+    lost    = [gene_is_lost(tree, n) for n in index.nodes]
+    species = [tree.node[n]['S'] for n in index.nodes]
+
+    # without a table of all interactions, a pair of genes interacts if neither is lost
+    # and both are alive at once within the same species (exactly as for iter_gene_pairs)
+    def interacts(a, b):
+        if lost[a] or lost[b]:
+            return False
+        return a == b or (species[a] == species[b] and
+                          t_birth[a] < t_death[b] and t_birth[b] < t_death[a])
 
-            continue
+    return interacts
 
-        # the genes must be from the same species in order to interact
-        if tree.node[geneA]['S'] != tree.node[geneB]['S']:
-            continue
 
-        # if geneA died before or at same time as geneB born, no interaction
-        if tree.node[geneA]['t_death'] <= tree.node[geneB]['t_birth']:
-            continue
+def _make_walker(tree, index, t_birth, t_death):
+    return PairWalker(index, t_birth, t_death, _lifespans_overlap(tree, index, t_birth, t_death))
 
-        # if geneB died before or at same time as geneA born, no interaction
-        if tree.node[geneB]['t_death'] <= tree.node[geneA]['t_birth']:
-            continue
 
-        inode = make_new_inode(tree, geneA, geneB)
+def _species_genes(tree, index):
 
-        # this new node hangs from the parent genes
-        tree.add_edge(geneA, inode, distance=0.0)
-        tree.add_edge(geneB, inode, distance=0.0)
+    # genes from different species never interact, so each species is handled separately
+    species_genes = defaultdict(list)
+    for gene in index.nodes:
+        species_genes[tree.node[gene]['S']].append(gene)
 
-    # now each inode must be connected to its parent interaction
-    for inode in [n for n in tree.nodes() if tree.node[n]['node_type'] == 'interaction']:
-        add_inode_parent(tree, inode)
+    return list(species_genes.values())
 
-    for s, t in [(s, t) for s, t in tree.edges()
-                 if tree.edge[s][t].get('edge_type', '') == 'interaction']:
 
-        add_inode_distance(tree, s, t)
+def _species_pairs(tree, index, t_birth, t_death, genes):
+
+    births = {gene: t_birth[index.node_id[gene]] for gene in genes}
+    deaths = {gene: t_death[index.node_id[gene]] for gene in genes}
+
+    return [(index.node_id[geneA], index.node_id[geneB])
+            for geneA, geneB in iter_gene_pairs(tree, genes, births, deaths)]
+
+
+def _resolve_parents(index, walker, gene_a, gene_b):
+
+    # the parent of each pair of genes is found by walking back through the gene tree,
+    # while the distances are then found for all the pairs together, as array operations
+    parents = [walker.parent_pair(a, b) for a, b in zip(gene_a.tolist(), gene_b.tolist())]
+
+    parent_a = np.array([pair[0] if pair else -1 for pair in parents], dtype=int)
+    parent_b = np.array([pair[1] if pair else -1 for pair in parents], dtype=int)
+
+    has_parent = parent_a >= 0
+
+    evol_dist = np.full(len(parents), np.nan)
+    evol_dist[has_parent] = evol_distances(index, gene_a[has_parent], gene_b[has_parent],
+                                           parent_a[has_parent], parent_b[has_parent])
+
+    return parent_a, parent_b, evol_dist
+
+
+def _ancestral_pairs(tree, index, t_birth, t_death, position, genes):
+
+    walker = _make_walker(tree, index, t_birth, t_death)
+
+    # starting from every interaction between the given genes, we walk back through the
+    # parent interactions until reaching one that has already been found (or the root)
+    # each parent is walked in the order of its genes within the tree, as in build_inodes
+    found = set()
+    for a, b in _species_pairs(tree, index, t_birth, t_death, genes):
+        pair = (a, b) if position[a] <= position[b] else (b, a)
+        while pair is not None and pair not in found:
+            found.add(pair)
+            pair = walker.parent_pair(*pair)
+            if pair is not None and position[pair[0]] > position[pair[1]]:
+                pair = (pair[1], pair[0])
+
+    return found
+
+
+# state of each worker process, when building the inodes with a process pool
+_worker = {}
+
+
+def _start_worker(tree, index, t_birth, t_death):
+    _worker['args']   = (tree, index, t_birth, t_death)
+    _worker['walker'] = _make_walker(tree, index, t_birth, t_death)
+
+
+def _worker_pairs(genes):
+    return _species_pairs(*(_worker['args'] + (genes,)))
+
+
+def _worker_parents(genes):
+    return _resolve_parents(_worker['args'][1], _worker['walker'], *genes)
+
+
+def build_inodes(tree, index=None, t_birth=None, t_death=None, workers=None, genes=None):
+    """construct every interaction of a labelled gene tree, as a CompactITree
+
+    the gene tree is only read, and inodes are ordered according to their genes within it
+    t_birth and t_death give the times of each gene id within the index, and are read
+    from the tree if not given (such that an unlabelled gene tree may be used directly)
+    if workers is given, the species and their inodes are split across a process pool
+    if genes is given, only the interactions between those genes are constructed,
+    along with all their ancestral interactions (to the root)"""
+
+    if index is None:
+        index = TreeIndex(tree)
+
+    t_birth, t_death = _gene_times(tree, index, t_birth, t_death)
+
+    pool = None
+    if workers:
+        pool = Pool(workers, initializer=_start_worker,
+                    initargs=(tree, index, t_birth, t_death))
+        map_species = map_chunks = pool.map
+    else:
+        walker = _make_walker(tree, index, t_birth, t_death)
+
+        def map_species(function, species):
+            return [_species_pairs(tree, index, t_birth, t_death, genes) for genes in species]
+
+        def map_chunks(function, chunks):
+            return [_resolve_parents(index, walker, *chunk) for chunk in chunks]
+
+    # inodes follow the order of the genes within the tree,
+    # such that the resulting iTree does not depend on the order of the sweep
+    position = [0] * len(index)
+    for i, gene in enumerate(tree.nodes()):
+        position[index.node_id[gene]] = i
+
+    try:
+        if genes is None:
+            pairs = [pair for pairs in map_species(_worker_pairs, _species_genes(tree, index))
+                     for pair in pairs]
+            pairs = [(a, b) if position[a] <= position[b] else (b, a) for a, b in pairs]
+        else:
+            pairs = list(_ancestral_pairs(tree, index, t_birth, t_death, position, genes))
+        pairs.sort(key=lambda pair: (position[pair[0]], position[pair[1]]))
+
+        gene_a = np.array([a for a, b in pairs], dtype=int)
+        gene_b = np.array([b for a, b in pairs], dtype=int)
+
+        # each inode must be connected to its parent interaction
+        # contiguous runs of inodes (ie. from the same part of the gene tree) are resolved together
+        n_chunks = max(1, min(len(pairs) // 1024, 4 * (workers or 1)))
+        chunks = list(zip(np.array_split(gene_a, n_chunks), np.array_split(gene_b, n_chunks)))
+
+        resolved = map_chunks(_worker_parents, chunks)
+
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    parent_a  = np.concatenate([parent_a for parent_a, parent_b, evol_dist in resolved])
+    parent_b  = np.concatenate([parent_b for parent_a, parent_b, evol_dist in resolved])
+    evol_dist = np.concatenate([evol_dist for parent_a, parent_b, evol_dist in resolved])
+
+    # each interaction is identified by a single integer key, packed from its gene ids
+    # so parents are found with a single sorted search over all of them
+    keys  = pack_pairs(gene_a, gene_b)
+    order = np.argsort(keys)
+
+    has_parent = parent_a >= 0
+
+    parent = np.full(len(pairs), -1, dtype=np.int64)
+    parent[has_parent] = order[np.searchsorted(keys[order], pack_pairs(parent_a[has_parent],
+                                                                       parent_b[has_parent]))]
+
+    # each interaction takes the species of its genes, interned as integer codes
+    species_table = SymbolTable(tree.node[n]['S'] for n in index.nodes)
+    gene_species  = np.array([species_table.ids[tree.node[n]['S']] for n in index.nodes],
+                             dtype=np.int32)
+
+    t_birth = np.array(t_birth)
+    t_death = np.array(t_death)
+
+    return CompactITree(genes=index.nodes,
+                        gene_names=[tree.node[n]['name'] for n in index.nodes],
+                        species_names=species_table.names,
+                        gene_a=gene_a,
+                        gene_b=gene_b,
+                        species=gene_species[gene_a],
+                        parent=parent,
+                        evol_dist=evol_dist,
+                        t_birth=np.maximum(t_birth[gene_a], t_birth[gene_b]),
+                        t_death=np.minimum(t_death[gene_a], t_death[gene_b]),
+                        graph=tree.graph)
+
+
+def _sorted_species_pairs(tree, index, genes, births, deaths, position, depth):
+
+    # a parent interaction is never born after its child, and always has fewer gene tree
+    # edges between its genes and the root, so (birth, depth) is a topological order
+    # within each species, the sweep finds the pairs in order of birth, so only the pairs
+    # born together need to be sorted before merging the species into a single stream
+    def keyed_pairs():
+        for geneA, geneB in iter_gene_pairs(tree, genes, births, deaths):
+            if position[geneA] > position[geneB]:
+                geneA, geneB = geneB, geneA
+            a, b = index.node_id[geneA], index.node_id[geneB]
+            yield max(births[geneA], births[geneB]), depth[a] + depth[b], a, b
+
+    for _, batch in groupby(keyed_pairs(), key=lambda pair: pair[0]):
+        for pair in sorted(batch):
+            yield pair
+
+
+def iter_inodes(tree, index=None, t_birth=None, t_death=None, batch_size=1024):
+    """generate every interaction of a labelled gene tree, as (inode, parent, evol_dist)
+
+    interactions are streamed in topological order (every parent before its children),
+    without ever holding the whole iTree in memory, and the root has a parent of None
+    t_birth and t_death are as for build_inodes"""
+
+    if index is None:
+        index = TreeIndex(tree)
+
+    t_birth, t_death = _gene_times(tree, index, t_birth, t_death)
+
+    depth    = [int(d) for d in index.depth]
+    position = {gene: i for i, gene in enumerate(tree.nodes())}
+
+    walker = _make_walker(tree, index, t_birth, t_death)
+
+    births = dict(zip(index.nodes, t_birth))
+    deaths = dict(zip(index.nodes, t_death))
+
+    stream = merge(*[_sorted_species_pairs(tree, index, genes, births, deaths, position, depth)
+                     for genes in _species_genes(tree, index)])
+
+    # parents and distances are resolved a batch at a time, so that the distances
+    # can still be found with array operations
+    while True:
+        batch = list(islice(stream, batch_size))
+        if not batch:
+            return
+
+        gene_a = np.array([a for _, _, a, b in batch], dtype=int)
+        gene_b = np.array([b for _, _, a, b in batch], dtype=int)
+
+        parent_a, parent_b, evol_dist = _resolve_parents(index, walker, gene_a, gene_b)
+
+        for i, (a, b) in enumerate(zip(gene_a, gene_b)):
+            inode = get_inode_name(index.nodes[a], index.nodes[b])
+            if parent_a[i] < 0:
+                yield inode, None, None
+            else:
+                yield (inode, get_inode_name(index.nodes[parent_a[i]], index.nodes[parent_b[i]]),
+                       float(evol_dist[i]))
+
+
+def add_all_inodes(tree):
+    """function to construct interaction tree, given suitably annotated gene tree"""
+
+    itree = build_inodes(tree)
 
     # we don't want the gTree nodes actually remaining as part of the iTree
-    tree.remove_nodes_from([n for n in tree.nodes() if tree.node[n]['node_type'] == 'gene'])
+    tree.remove_nodes_from(tree.nodes())
 
-    # instead of inscrutable numbers as the nodes,
-    # we relabel using the 'name' property
+    itree.to_networkx(graph=tree)
 
     return tree
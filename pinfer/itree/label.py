@@ -1,5 +1,12 @@
+from .index import TreeIndex
 
-import networkx as nx
+
+def bumped_distance(source, target, data):
+    """branch distance, with zero distances bumped to a tiny (but non-zero) value"""
+
+    if data['distance'] == 0.0:
+        return 1e-10
+    return data['distance']
 
 
 def _bump_zero_distance_children(tree):
@@ -8,11 +15,11 @@ def _bump_zero_distance_children(tree):
         tree.edge[s][t]['distance'] = 1e-10
 
 
-def _label_starter_nodes(tree):
+def _species_times(tree, index):
 
     # we construct a list of all non-leaf species, in tree order
     non_leaf_species = []
-    for node in [n for n in nx.topological_sort(tree) if tree.successors(n)]:
+    for node in [n for n in index.nodes if tree.successors(n)]:
         # we are only interested in the speciation nodes (ie. *not* duplication)
         if tree.node[node]['D'] == 'N':
             # need to make sure the list is unique
@@ -25,58 +32,101 @@ def _label_starter_nodes(tree):
     # all the leaves are fixed to be at the next availble integer time
     leaf_time = len(species2time) + 1.0
 
-    # every non-duplication node is initialised with a t_death property
+    return species2time, leaf_time
+
+
+def _label_starter_nodes(tree, index, species_times=None):
+
+    species2time, leaf_time = species_times or _species_times(tree, index)
+
+    # every non-duplication node is initialised with a t_death
     # this includes the leaves
-    for node in [n for n in tree.nodes() if tree.node[n]['D'] == 'N']:
-        tree.node[node]['t_death'] = species2time.get(tree.node[node]['S'], leaf_time)
+    t_death = [None] * len(index)
+    for i, node in enumerate(index.nodes):
+        if tree.node[node]['D'] == 'N':
+            t_death[i] = species2time.get(tree.node[node]['S'], leaf_time)
 
     # finally, the root is defined to have a t_death of zero
-    tree.node[nx.topological_sort(tree)[0]]['t_death'] = 0.0
+    t_death[0] = 0.0
 
+    return t_death
 
-def _determine_t_death(tree, target):
 
-    # find the time of parent and the distance from it
-    parent = tree.predecessors(target)[0]
+def _find_farthest_descendants(tree, index, t_death):
 
-    start_dist = tree.edge[parent][target]['distance']
-    start_time = tree.node[parent]['t_death']
+    # for every node we find the most distant descendant within the same species that
+    # already has a t_death, along with the distance to it
+    # this is achieved with a single pass over the tree, from the leaves upwards
+    distance = index.weight.tolist()
 
-    # build list of descendants within the same species
-    descendants = [n for n in nx.descendants(tree, target)
-                   if tree.node[n]['S'] == tree.node[target]['S']]
+    farthest = [None] * len(index)
 
-    # find the most distant descendant with 't_death' label
-    distances_times = []
-    for node in descendants:
-        distance_time = (
-            nx.shortest_path_length(tree, source=target, target=node, weight='distance'),
-            tree.node[node].get('t_death', None)
-        )
-        distances_times.append(distance_time)
+    for i in reversed(range(len(index))):
 
-    # max_dist = max(distances)
-    distances_times.sort(key=lambda x: x[0])
+        species = tree.node[index.nodes[i]]['S']
 
-    end_dist, end_time = distances_times[-1]
+        for c in index.children[i]:
 
-    # t_death for node is between that of parent and descendant
-    # proportionate to the distance to each
-    t_death = start_time + (end_time - start_time) * (start_dist / (start_dist + end_dist))
+            if tree.node[index.nodes[c]]['S'] != species:
+                continue
 
-    tree.node[target]['t_death'] = t_death
+            candidates = []
+            if t_death[c] is not None:
+                candidates.append((distance[c], t_death[c]))
+            if farthest[c] is not None:
+                candidates.append((distance[c] + farthest[c][0], farthest[c][1]))
 
+            for candidate in candidates:
+                if farthest[i] is None or candidate[0] > farthest[i][0]:
+                    farthest[i] = candidate
 
-def _add_t_births_and_lengths(tree):
+    return farthest
 
-    for s, t in tree.edges():
 
-        tree.node[t]['t_birth'] = tree.node[s]['t_death']
+def _determine_t_deaths(tree, index, t_death):
 
-        tree.edge[s][t]['length'] = tree.node[t]['t_death'] - tree.node[t]['t_birth']
+    farthest = _find_farthest_descendants(tree, index, t_death)
+
+    distance = index.weight.tolist()
+
+    # now we need to label all remaining nodes
+    # best achieved in topological order, so each parent is labelled before its children
+    for i, target in enumerate(index.nodes):
+
+        if t_death[i] is not None:
+            continue
+
+        if farthest[i] is None:
+            raise Exception('No labelled descendant of %s within the same species!' % target)
+
+        # find the time of parent and the distance from it
+        start_dist = distance[i]
+        start_time = t_death[index.parent[i]]
 
-    # finally, the root is defined to have a birth time of -1.0
-    tree.node[nx.topological_sort(tree)[0]]['t_birth'] = -1.0
+        end_dist, end_time = farthest[i]
+
+        # t_death for node is between that of parent and descendant
+        # proportionate to the distance to each
+        t_death[i] = start_time + (end_time - start_time) * (start_dist / (start_dist + end_dist))
+
+
+def birth_death_times(tree, index, species_times=None):
+    """birth and death times for each node id within the index, without modifying the tree
+
+    the index must be weighted by (bumped) branch distances
+    species_times may be given as (the time of each non-leaf species, the time of the leaves),
+    such that part of a tree can be labelled consistently with the whole tree"""
+
+    # all the speciciation nodes have pre-defined times
+    t_death = _label_starter_nodes(tree, index, species_times)
+
+    # all remaining nodes are labelled relative to their parent and descendants
+    _determine_t_deaths(tree, index, t_death)
+
+    # each node is born when its parent dies, and the root is defined to be born at -1.0
+    t_birth = [t_death[p] if p >= 0 else -1.0 for p in index.parent]
+
+    return t_birth, t_death
 
 
 def label_birth_death(tree):
@@ -84,14 +134,15 @@ def label_birth_death(tree):
 
     _bump_zero_distance_children(tree)
 
-    # all the speciciation nodes have pre-defined times
-    _label_starter_nodes(tree)
+    index = TreeIndex(tree)
 
-    # now we need to label all remaining nodes
-    # best achieved in topological order
-    for node in [n for n in nx.topological_sort(tree) if 't_death' not in tree.node[n]]:
-        _determine_t_death(tree, node)
+    t_birth, t_death = birth_death_times(tree, index)
 
-    _add_t_births_and_lengths(tree)
+    for i, node in enumerate(index.nodes):
+        tree.node[node]['t_death'] = t_death[i]
+        tree.node[node]['t_birth'] = t_birth[i]
+
+    for s, t in tree.edges():
+        tree.edge[s][t]['length'] = tree.node[t]['t_death'] - tree.node[t]['t_birth']
 
     return
@@ -1,51 +1,57 @@
 
-import networkx as nx
+from collections import defaultdict
+
+from .index import TreeIndex
 
 
 def _add_normalised_edge_lengths(tree):
     """annotate all edges such that total depth of tree is normalised to one within each species"""
 
-    def relabel_weights(tree, effective_root, remaining_length=1.0):
+    index = TreeIndex(tree)
+
+    def distance(i, c):
+        return tree.edge[index.nodes[i]][index.nodes[c]]['distance']
 
-        for child in tree.edge[effective_root]:
+    # each species is normalised within the subtree formed by its nodes and their parents
+    # these are gathered for every species in a single pass over the tree
+    members = defaultdict(set)
+    for i, node in enumerate(index.nodes):
+        members[tree.node[node]['S']].add(i)
+        if index.parent[i] >= 0:
+            members[tree.node[node]['S']].add(index.parent[i])
 
-            max_dist = tree.edge[effective_root][child]['distance'] + \
-                max([
-                    d for n, d in
-                    nx.shortest_path_length(tree, source=child, weight='distance').items()
-                ])
+    all_species = set([tree.node[n]['S'] for n in tree.nodes()])
 
-            original_length = tree.edge[effective_root][child]['distance']
+    for species in all_species:
 
-            new_length      = remaining_length * (original_length / max_dist)
+        # ascending ids are a topological order of the subtree
+        nodes = sorted(members[species])
 
-            # label outgoing edges with the appropriate fraction of the remaining length
-            tree.edge[effective_root][child]['length'] = new_length
+        children = {i: [c for c in index.children[i] if c in members[species]] for i in nodes}
 
-            # call relabel_weights with each child as effective root, and correct remaining length
-            relabel_weights(tree, child, remaining_length=(remaining_length - new_length))
+        # first pass (leaves upward) finds the greatest distance below each node
+        max_below = {}
+        for i in reversed(nodes):
+            max_below[i] = max([0.0] + [distance(i, c) + max_below[c] for c in children[i]])
 
-        return
+        # second pass (root downward) hands each edge its fraction of the remaining length
+        # any node not reached from a parent is the root of its own subtree
+        remaining_length = {}
+        for i in nodes:
 
-    all_species = set([tree.node[n]['S'] for n in tree.nodes()])
+            remaining_length.setdefault(i, 1.0)
 
-    for i, species in enumerate(all_species):
+            for c in children[i]:
 
-        nodes = [n for n in tree.nodes() if tree.node[n]['S'] == species]
+                max_dist = distance(i, c) + max_below[c]
 
-        # add parents to the set of nodes
-        parents = set()
-        for node in nodes:
-            if tree.predecessors(node):
-                parents.add(tree.predecessors(node)[0])
+                original_length = distance(i, c)
 
-        subTree = nx.subgraph(tree, nodes + list(parents))
+                new_length      = remaining_length[i] * (original_length / max_dist)
 
-        for root in [n for n in subTree.nodes() if not subTree.predecessors(n)]:
-            relabel_weights(subTree, root)
+                tree.edge[index.nodes[i]][index.nodes[c]]['length'] = new_length
 
-        for s, t in subTree.edges():
-            tree.edge[s][t]['length'] = subTree.edge[s][t]['length']
+                remaining_length[c] = remaining_length[i] - new_length
 
     return
 
@@ -55,15 +61,15 @@ def label_birth_death(tree):
 
     _add_normalised_edge_lengths(tree)
 
-    root = [n for n in tree.nodes() if not tree.predecessors(n)][0]
+    index = TreeIndex(tree, weight='length')
 
-    for n, d in nx.shortest_path_length(tree, root, weight='length').items():
-        tree.node[n]['t_death'] = d + 1.0
+    for i, n in enumerate(index.nodes):
+        tree.node[n]['t_death'] = float(index.root_distance[i]) + 1.0
 
-    for n in tree.nodes():
-        try:
-            tree.node[n]['t_birth'] = tree.node[tree.predecessors(n)[0]]['t_death']
-        except IndexError:
+    for i, n in enumerate(index.nodes):
+        if index.parent[i] >= 0:
+            tree.node[n]['t_birth'] = tree.node[index.nodes[index.parent[i]]]['t_death']
+        else:
             tree.node[n]['t_birth'] = 0.0
 
     return
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""incremental updates of interaction trees, following changes to the gene tree"""
+
+from __future__ import print_function, division
+
+from collections import defaultdict
+
+import networkx as nx
+import numpy as np
+
+from . import _gene_times
+from .interact import _make_walker, _resolve_parents
+from .label import _species_times
+from .utils import get_inode_name, gene_is_lost
+
+
+def _gene_states(gTree, species_times=None):
+
+    index, t_birth, t_death = _gene_times(gTree, species_times)
+
+    states = {}
+    for i, gene in enumerate(index.nodes):
+        parent = index.nodes[index.parent[i]] if index.parent[i] >= 0 else None
+        states[gene] = (parent, t_birth[i], t_death[i], float(index.weight[i]))
+
+    return index, t_birth, t_death, states
+
+
+def _species_members(gTree):
+
+    members = defaultdict(list)
+    for gene in gTree.nodes():
+        if not gene_is_lost(gTree, gene):
+            members[gTree.node[gene]['S']].append(gene)
+
+    return members
+
+
+def _region(gTree, genes):
+
+    # the genes whose times may depend on the tree below the given genes, ie. those on the
+    # path from the root, and their descendants within the same species (as a duplication
+    # is timed between its parent and its farthest descendant within the same species)
+    region = set()
+    for gene in genes:
+        while gene is not None and gene not in region:
+            region.add(gene)
+            gene = (gTree.predecessors(gene) or [None])[0]
+
+    stack = list(region)
+    while stack:
+        gene = stack.pop()
+        for child in gTree.successors(gene):
+            if child not in region and gTree.node[child]['S'] == gTree.node[gene]['S']:
+                region.add(child)
+                stack.append(child)
+
+    return region
+
+
+def _snapshot(gTree, added, removed, distances):
+
+    # a copy of the part of the gene tree whose times may be changed, as it was before the
+    # change, unless a gene becomes (or stops being) a leaf, which can move the time of
+    # every speciation, and so every gene, in which case the whole tree is copied
+    relabel = any(not gTree.successors(parent) for parent, _, _, _ in added)
+    changes = [parent for parent, _, _, _ in added] + list(child for _, child in distances)
+    for leaf in removed:
+        parent = gTree.predecessors(leaf)[0]
+        relabel = relabel or set(gTree.successors(parent)) <= set(removed)
+        changes.append(parent)
+
+    genes = gTree.nodes() if relabel else _region(gTree, changes)
+
+    # only the properties used to find the times are copied
+    snapshot = nx.DiGraph()
+    for gene in genes:
+        snapshot.add_node(gene, S=gTree.node[gene]['S'], D=gTree.node[gene]['D'])
+    for gene in genes:
+        for child in gTree.successors(gene):
+            if child in snapshot:
+                snapshot.add_edge(gene, child, distance=gTree.edge[gene][child]['distance'])
+
+    return snapshot, relabel
+
+
+def _stale_inodes(iTree, gTree, genes, members):
+
+    # the inodes of the iTree involving any of the given genes
+    stale = set()
+    for gene in genes:
+        if gene_is_lost(gTree, gene):
+            continue
+        for other in members[gTree.node[gene]['S']]:
+            inode = get_inode_name(gene, other)
+            if inode in iTree:
+                stale.add(inode)
+
+    return stale
+
+
+def _overlapping_pairs(gTree, genes, states, members):
+
+    # all pairs of (non-lost) genes involving any of the given genes, which are alive together
+    # according to the given states (such that genes without a state are ignored)
+    pairs = set()
+    for gene in genes:
+        if gene_is_lost(gTree, gene):
+            continue
+        _, t_birth, t_death, _ = states[gene]
+        for other in members[gTree.node[gene]['S']]:
+            if other not in states:
+                continue
+            if other == gene or (t_birth < states[other][2] and states[other][1] < t_death):
+                pairs.add(tuple(sorted((gene, other))))
+
+    return pairs
+
+
+def _apply_changes(gTree, members, added, removed, distances):
+
+    # the species members are kept in step with the gene tree
+    for leaf in removed:
+        if leaf in members[gTree.node[leaf]['S']]:
+            members[gTree.node[leaf]['S']].remove(leaf)
+
+    gTree.remove_nodes_from(removed)
+
+    for parent, leaf, distance, properties in added:
+        if leaf in gTree:
+            raise Exception('%s is already in the gene tree!' % leaf)
+        gTree.add_node(leaf, **dict({'name': leaf}, **properties))
+        gTree.add_edge(parent, leaf, distance=distance)
+        if not gene_is_lost(gTree, leaf):
+            members[gTree.node[leaf]['S']].append(leaf)
+
+    for (parent, child), distance in distances.items():
+        gTree.edge[parent][child]['distance'] = distance
+
+
+def _add_inodes(iTree, gTree, index, t_birth, t_death, pairs):
+
+    for geneA, geneB in pairs:
+        iTree.add_node(get_inode_name(geneA, geneB),
+                       name=get_inode_name(gTree.node[geneA]['name'], gTree.node[geneB]['name']),
+                       node_type='interaction',
+                       S=gTree.node[geneA]['S'])
+
+    if not pairs:
+        return
+
+    walker = _make_walker(gTree, index, t_birth, t_death)
+
+    gene_a = np.array([index.node_id[geneA] for geneA, geneB in pairs], dtype=int)
+    gene_b = np.array([index.node_id[geneB] for geneA, geneB in pairs], dtype=int)
+
+    parent_a, parent_b, evol_dist = _resolve_parents(index, walker, gene_a, gene_b)
+
+    for i, (geneA, geneB) in enumerate(pairs):
+        if parent_a[i] >= 0:
+            iTree.add_edge(get_inode_name(index.nodes[parent_a[i]], index.nodes[parent_b[i]]),
+                           get_inode_name(geneA, geneB),
+                           edge_type='interaction', evol_dist=float(evol_dist[i]))
+
+
+def update_itree(iTree, gTree, added=(), removed=(), distances=None):
+    """update an iTree in place, following a change to its gene tree
+
+    added is a list of new leaves, each given as (parent, leaf, distance, properties),
+    where properties hold the node properties of the leaf (eg. 'S' and 'D')
+    removed is a list of leaves to remove, and distances maps (parent, child) edges
+    to their new distance
+    the gene tree is modified accordingly, and only the inodes involving a gene whose
+    lifespan or ancestry has changed (or their descendants) are removed and rebuilt"""
+
+    distances = distances or {}
+
+    for leaf in removed:
+        if gTree.successors(leaf):
+            raise Exception('Only leaves can be removed from the gene tree!')
+
+    snapshot, relabel = _snapshot(gTree, added, removed, distances)
+
+    members = _species_members(gTree)
+    stale   = _stale_inodes(iTree, gTree, removed, members)
+
+    _apply_changes(gTree, members, added, removed, distances)
+
+    index, t_birth, t_death, new_states = _gene_states(gTree)
+
+    # outside the snapshot, times are unchanged, and within it they are compared with the
+    # times from before the change, found with the same speciation times as the whole tree
+    _, _, _, old_states = _gene_states(snapshot, None if relabel else _species_times(gTree, index))
+
+    # every gene whose own state changed, along with all its descendants, is affected
+    candidates = [g for g in old_states if g in new_states] + [leaf for _, leaf, _, _ in added]
+    changed    = [index.node_id[g] for g in candidates if old_states.get(g) != new_states[g]]
+    affected   = set()
+    while changed:
+        i = changed.pop()
+        if i not in affected:
+            affected.add(i)
+            changed.extend(index.children[i])
+    affected = [index.nodes[i] for i in affected]
+
+    stale.update(_stale_inodes(iTree, gTree, affected, members))
+
+    iTree.remove_nodes_from(stale)
+
+    # the new inodes are ordered by the position of their genes, exactly as in build_inodes
+    position = {gene: i for i, gene in enumerate(gTree.nodes())}
+    pairs = sorted([sorted(pair, key=position.get)
+                    for pair in _overlapping_pairs(gTree, affected, new_states, members)],
+                   key=lambda pair: (position[pair[0]], position[pair[1]]))
+
+    _add_inodes(iTree, gTree, index, t_birth, t_death, pairs)
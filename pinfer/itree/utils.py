@@ -1,3 +1,4 @@
+import numpy as np
 
 
 def gene_is_lost(iTree, gene):
@@ -10,3 +11,53 @@ def get_inode_name(geneA, geneB):
     # crucially, these are always sorted so the order in which genes are passed is irrelevant
     return '%s-%s' % tuple(sorted((geneA, geneB)))
 
+
+def pack_pair(a, b):
+    """single integer key for the unordered pair of (integer) gene ids a and b"""
+    return (a << 32) | b if a <= b else (b << 32) | a
+
+
+def pack_pairs(a, b):
+    """single integer keys for the unordered pairs of gene ids within arrays a and b"""
+    a = np.asarray(a, dtype=np.int64)
+    b = np.asarray(b, dtype=np.int64)
+    return (np.minimum(a, b) << 32) | np.maximum(a, b)
+
+
+def unpack_pairs(keys):
+    """arrays of the (ordered) gene ids within packed pair keys"""
+    keys = np.asarray(keys, dtype=np.int64)
+    return keys >> 32, keys & 0xffffffff
+
+
+class SymbolTable(object):
+    """interned integer ids for names (eg. of genes or species), in order of first appearance"""
+
+    def __init__(self, names=()):
+
+        self.names = []
+        self.ids   = {}
+
+        for name in names:
+            self.intern(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def intern(self, name):
+        """the id of name, which is added to the table if not already present"""
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+        return self.ids[name]
+
+    def lookup(self, names):
+        """array of the ids of all the given names, with -1 for any not within the table
+
+        each distinct name is only looked up once, such that long arrays are handled quickly"""
+        unique, codes = np.unique(np.asarray(names), return_inverse=True)
+        ids = np.array([self.ids.get(name, -1) for name in unique.tolist()], dtype=np.int64)
+        return ids[codes.reshape(-1)]
@@ -52,6 +52,127 @@ class TestITree(unittest.TestCase):
         assert sorted(dictA.keys()) == sorted(dictB.keys())
         assert sorted(dictA.values()) == sorted(dictB.values())
 
+    def test_notung_import_native(self):
+        import bz2
+        import gzip
+        import shutil
+        import tempfile
+        from pinfer.io import load_notung_nhx, original_load_notung_nhx
+
+        filename = sep.join(tests_folder + ['data', 'tree.newick'])
+
+        # the native parser must give exactly the same tree as by way of Bio.Phylo
+        expected = original_load_notung_nhx(filename)
+
+        folder = tempfile.mkdtemp()
+        try:
+            for opener, suffix in [(open, ''), (gzip.open, '.gz'), (bz2.BZ2File, '.bz2')]:
+                copy = sep.join([folder, 'tree.newick' + suffix])
+                with open(filename, 'rb') as f_in, opener(copy, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+
+                gTree = load_notung_nhx(copy)
+
+                assert gTree.nodes(data=True) == expected.nodes(data=True)
+                assert gTree.edges(data=True) == expected.edges(data=True)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_notung_batch_import(self):
+        import gzip
+        import shutil
+        import tempfile
+        from pinfer.io import iter_notung_nhx
+
+        filename = sep.join(tests_folder + ['data', 'tree.newick'])
+
+        folder = tempfile.mkdtemp()
+        try:
+            for family in ['famA', 'fam.1', 'fam.2']:
+                shutil.copy(filename, sep.join([folder, family + '.ntg']))
+            # compressed files are named without the compression suffix
+            with open(filename, 'rb') as f, gzip.open(sep.join([folder, 'famB.ntg.gz']), 'wb') as g:
+                g.write(f.read())
+            with open(sep.join([folder, 'broken.ntg']), 'w') as f:
+                f.write('((A:1,B:1)C:1;')
+
+            for workers in [None, 2]:
+                failures = {}
+                families = dict(iter_notung_nhx(folder, workers=workers, failures=failures))
+
+                # a failure to parse one file must not prevent the others from loading
+                assert sorted(families) == ['fam.1', 'fam.2', 'famA', 'famB']
+                assert list(failures) == ['broken']
+                for gTree in families.values():
+                    assert gTree.edges(data=True) == self.gTree.edges(data=True)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_binary_format(self):
+        import shutil
+        import tempfile
+        from pinfer import build_itree
+        from pinfer.io import save_gene_tree, load_gene_tree, save_itree, load_itree
+
+        folder = tempfile.mkdtemp()
+        try:
+            # gene trees must be recovered exactly, including the order of nodes and edges
+            for gTree in [self.gTree, self.gTree_processed]:
+                save_gene_tree(gTree, sep.join([folder, 'gTree']))
+                loaded = load_gene_tree(sep.join([folder, 'gTree']))
+
+                assert loaded.graph == gTree.graph
+                assert loaded.nodes(data=True) == gTree.nodes(data=True)
+                assert loaded.edges(data=True) == gTree.edges(data=True)
+
+            compact = build_itree(self.gTree, compact=True)
+            save_itree(compact, sep.join([folder, 'iTree']))
+            loaded = load_itree(sep.join([folder, 'iTree']))
+
+            # the arrays of the iTree are mapped from disk, rather than read into memory
+            assert isinstance(loaded.parent.base, np.memmap)
+
+            iTree    = compact.to_networkx()
+            exported = loaded.to_networkx()
+            assert exported.graph == iTree.graph
+            assert exported.nodes(data=True) == iTree.nodes(data=True)
+            assert exported.edges(data=True) == iTree.edges(data=True)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_ppi_import(self):
+        import gzip
+        import shutil
+        import tempfile
+        from pinfer import build_itree
+        from pinfer.io import load_ppi
+
+        compact = build_itree(self.gTree, compact=True)
+
+        lines = ['#Ci', '131584_Ci\t139315_Ci\t31.5', '131584_Ci\t131584_Ci\t-2.0', '//',
+                 '#Hs', 'XBP11_Hs\tATF62_Hs\t12.0', 'XBP11_Hs\tunknown_Hs\t40.0']
+
+        folder = tempfile.mkdtemp()
+        try:
+            filename = sep.join([folder, 'screen.ppi.gz'])
+            with gzip.open(filename, 'wb') as f:
+                f.write('\n'.join(lines).encode('utf-8'))
+
+            ppi = load_ppi(filename, iTree=compact, threshold=30.0)
+        finally:
+            shutil.rmtree(folder)
+
+        assert list(ppi['species']) == ['Ci', 'Ci', 'Hs', 'Hs']
+        assert (ppi['score'] == np.array([31.5, -2.0, 12.0, 40.0])).all()
+        assert (ppi['evidence'] == np.array([[0, 1], [1, 0], [1, 0], [0, 1]])).all()
+
+        # pairs are matched to the ids of their interaction, regardless of gene order
+        keys = compact.inode_keys()
+        assert keys[ppi['inode'][0]] == '131584_Ci-139315_Ci'
+        assert keys[ppi['inode'][1]] == '131584_Ci-131584_Ci'
+        assert keys[ppi['inode'][2]] == 'ATF62_Hs-XBP11_Hs'
+        assert ppi['inode'][3] == -1
+
     def test_gtree_normalisation(self):
 
         gTree = self.gTree_processed
@@ -72,6 +193,32 @@ class TestITree(unittest.TestCase):
                         )]
         assert len(set(t_deaths)) == 1, 'Not all %s speciations are coincident.' % species
 
+    def test_t_death_interpolation(self):
+
+        gTree = self.gTree_processed
+
+        # each duplication sits between its parent and the most distant labelled
+        # descendant in the same species, in proportion to the distance to each
+        # (the root is excluded, since it is fixed to have a t_death of zero)
+        for node in [n for n in gTree.nodes()
+                     if gTree.node[n]['D'] == 'Y' and gTree.predecessors(n)]:
+
+            parent = gTree.predecessors(node)[0]
+
+            start_dist = gTree.edge[parent][node]['distance']
+            start_time = gTree.node[parent]['t_death']
+
+            distances = nx.shortest_path_length(gTree, node, weight='distance')
+            end_dist, end_time = max((distances[n], gTree.node[n]['t_death'])
+                                     for n in nx.descendants(gTree, node)
+                                     if gTree.node[n]['S'] == gTree.node[node]['S'] and
+                                     gTree.node[n]['D'] == 'N')
+
+            t_death = start_time + (end_time - start_time) * (start_dist /
+                                                              (start_dist + end_dist))
+
+            assert np.round(gTree.node[node]['t_death'] - t_death, 10) == 0.0
+
     # the paths from (effective) root to leaf within species must be of unit length
     def test_gtree_branch_lengths(self):
 
@@ -112,6 +259,408 @@ class TestITree(unittest.TestCase):
                         assert residual_length == 0.0, 'path from %s to %s not of unit length' % \
                             (gTree.node[root]['name'], gTree.node[leaf]['name'])
 
+    def test_normalised_labelling_deep_tree(self):
+        from pinfer.itree.label_recursive import label_birth_death
+
+        # a caterpillar tree, much deeper than the python recursion limit
+        tree = nx.DiGraph()
+        tree.add_node('root', S='A')
+        spine = 'root'
+        for i in range(5000):
+            for child, distance in [('spine%d' % i, 0.5), ('leaf%d' % i, 1.0 + i % 3)]:
+                tree.add_node(child, S='A')
+                tree.add_edge(spine, child, distance=distance)
+            spine = 'spine%d' % i
+
+        label_birth_death(tree)
+
+        # every leaf must be at unit (normalised) depth below the root
+        for leaf in [n for n in tree.nodes() if not tree.successors(n)]:
+            assert np.round(tree.node[leaf]['t_death'], 8) == 2.0
+
+        for s, t in tree.edges():
+            assert tree.node[s]['t_death'] == tree.node[t]['t_birth']
+
+    def test_gene_pair_sweep(self):
+        from itertools import combinations_with_replacement
+        from pinfer.itree.interact import iter_gene_pairs
+        from pinfer.itree.utils import gene_is_lost
+
+        gTree = self.gTree_processed
+
+        # the brute force all-pairs scan must find exactly the same interacting pairs
+        expected = set()
+        for geneA, geneB in combinations_with_replacement(gTree.nodes(), 2):
+            if gene_is_lost(gTree, geneA) or gene_is_lost(gTree, geneB):
+                continue
+            if geneA != geneB and (
+                    gTree.node[geneA]['S'] != gTree.node[geneB]['S'] or
+                    gTree.node[geneA]['t_death'] <= gTree.node[geneB]['t_birth'] or
+                    gTree.node[geneB]['t_death'] <= gTree.node[geneA]['t_birth']):
+                continue
+            expected.add(tuple(sorted((geneA, geneB))))
+
+        found = [tuple(sorted(pair)) for pair in iter_gene_pairs(gTree)]
+
+        assert len(found) == len(set(found))
+        assert set(found) == expected
+
+    def test_tree_index(self):
+        from pinfer.itree.index import TreeIndex
+
+        gTree = self.gTree_processed
+
+        index = TreeIndex(gTree)
+
+        assert index.root == nx.topological_sort(gTree)[0]
+        assert index.nodes == nx.topological_sort(gTree)
+
+        root_distances = nx.shortest_path_length(gTree, index.root, weight='distance')
+        depths = nx.shortest_path_length(gTree, index.root)
+
+        for i, node in enumerate(index.nodes):
+            parents = gTree.predecessors(node)
+            if parents:
+                assert index.nodes[index.parent[i]] == parents[0]
+            else:
+                assert index.parent[i] == -1
+            assert index.depth[i] == depths[node]
+            assert np.round(index.root_distance[i] - root_distances[node], 10) == 0.0
+
+        undirected = gTree.to_undirected()
+        ids = np.arange(len(index))
+        np.random.seed(0)
+        for a, b in np.random.randint(len(index), size=(200, 2)):
+            path = nx.shortest_path(undirected, index.nodes[a], index.nodes[b])
+            assert [index.nodes[i] for i in index.path(a, b)] == path
+            assert index.hops(a, b) == len(path) - 1
+            assert index.is_ancestor(a, b) == (index.nodes[a] in [index.nodes[b]] +
+                                               list(nx.ancestors(gTree, index.nodes[b])))
+
+        # queries may equally be made for arrays of node ids
+        assert (index.lca(ids, ids) == ids).all()
+        assert (index.lca(np.zeros_like(ids), ids) == 0).all()
+
+    def test_inode_distances(self):
+        from pinfer import build_itree
+
+        iTree = build_itree(self.gTree)
+        gTree = self.gTree_processed
+
+        def get_genes(inode):
+            geneA, geneB = inode.split('-')
+            return geneA, geneB
+
+        # evol_dist is the sum of the gene tree paths from parent genes to child genes
+        for s, t in iTree.edges():
+            genes   = set(get_genes(t))
+            parents = set(get_genes(s))
+            expected = 0.0
+            for parent in parents:
+                distances = nx.shortest_path_length(gTree, parent, weight='distance')
+                for gene in genes:
+                    expected += distances.get(gene, 0.0)
+            assert np.round(iTree.edge[s][t]['evol_dist'] - expected, 10) == 0.0
+
+    def test_inode_parents(self):
+        from pinfer import build_itree
+        from pinfer.itree.initialise import initialise_iTree
+        from pinfer.itree.label import label_birth_death
+        from pinfer.itree.interact import iter_gene_pairs, make_new_inode, add_inode_parent
+        from pinfer.itree.index import TreeIndex
+
+        iTree = build_itree(self.gTree)
+
+        # the parents found in a single batch must match the step by step walk back
+        tree = initialise_iTree(self.gTree)
+        label_birth_death(tree)
+
+        position = {gene: i for i, gene in enumerate(tree.nodes())}
+        pairs = sorted([sorted(pair, key=position.get) for pair in iter_gene_pairs(tree)],
+                       key=lambda pair: (position[pair[0]], position[pair[1]]))
+
+        index = TreeIndex(tree)
+
+        inodes = []
+        for geneA, geneB in pairs:
+            inodes.append(make_new_inode(tree, geneA, geneB))
+            tree.add_edge(geneA, inodes[-1])
+            tree.add_edge(geneB, inodes[-1])
+
+        for inode in inodes:
+            add_inode_parent(tree, inode, index=index)
+
+            parents = [n for n in tree.predecessors(inode)
+                       if tree.node[n]['node_type'] == 'interaction']
+            assert parents == iTree.predecessors(inode)
+
+    def test_compact_iTree(self):
+        from pinfer import build_itree
+
+        iTree = build_itree(self.gTree)
+        compact = build_itree(self.gTree, compact=True)
+
+        assert len(compact) == len(iTree.nodes())
+
+        # exporting to networkx must recover exactly the standard iTree
+        exported = compact.to_networkx()
+
+        assert exported.graph == iTree.graph
+        assert exported.nodes() == iTree.nodes()
+        assert exported.edges() == iTree.edges()
+        for node in iTree.nodes():
+            assert exported.node[node] == iTree.node[node]
+        for s, t in iTree.edges():
+            assert exported.edge[s][t] == iTree.edge[s][t]
+
+        # parents must always precede their children
+        order = compact.topological_order()
+        assert sorted(order) == list(range(len(compact)))
+        rank = np.argsort(order)
+        has_parent = compact.parent >= 0
+        assert (rank[compact.parent[has_parent]] < rank[has_parent]).all()
+
+        # interactions only exist while both genes are alive
+        assert (compact.t_birth < compact.t_death).all()
+
+    def test_compact_inference(self):
+        from pinfer import build_itree
+        from pinfer.infer import analyse_tree, analyse_compact
+
+        compact = build_itree(self.gTree, compact=True)
+
+        # every level holds the children of the level above
+        levels = compact.levels()
+        assert sorted(np.concatenate(levels)) == list(range(len(compact)))
+        for above, below in zip(levels, levels[1:]):
+            assert set(compact.parent[below]) <= set(above)
+
+        # CPTs from the evolutionary distances, with evidence on a few inodes
+        distance = np.nan_to_num(compact.evol_dist)
+        p_gain = 1 / (1 + np.exp(5 * distance + 2))
+        p_loss = 1 / (1 + np.exp(1 - 3 * distance))
+        CPT = np.stack([np.stack([1 - p_gain, p_gain], axis=1),
+                        np.stack([p_loss, 1 - p_loss], axis=1)], axis=1)
+        evidence = np.ones((len(compact), 2))
+        evidence[::97] = [0.1, 0.9]
+
+        beliefs = analyse_compact(compact, CPT, [0.5, 0.5], evidence)
+
+        # the same network, analysed as a networkx graph
+        iTree = compact.to_networkx()
+        keys = compact.inode_keys()
+        for i, key in enumerate(keys):
+            if compact.parent[i] >= 0:
+                iTree.node[key]['CPT'] = CPT[i]
+            else:
+                iTree.node[key]['prior'] = np.array([0.5, 0.5])
+            if i % 97 == 0:
+                iTree.node[key]['observation'] = evidence[i]
+        analyse_tree(iTree)
+
+        for i, key in enumerate(keys):
+            assert np.allclose(beliefs[i], iTree.node[key]['belief'])
+
+    def test_gtree_untouched(self):
+        from copy import deepcopy
+        from pinfer import build_itree
+        from pinfer.itree.interact import build_inodes
+
+        gTree = self.gTree
+        before = deepcopy(gTree)
+
+        iTree = build_itree(gTree)
+
+        # building the iTree must not modify the gene tree in any way
+        assert gTree.graph == before.graph
+        assert gTree.nodes(data=True) == before.nodes(data=True)
+        assert gTree.edges(data=True) == before.edges(data=True)
+
+        # and must match the iTree built from a fully labelled gene tree
+        labelled = build_inodes(self.gTree_processed).to_networkx()
+        assert iTree.nodes() == labelled.nodes()
+        for s, t in labelled.edges():
+            assert np.round(iTree.edge[s][t]['evol_dist'] - labelled.edge[s][t]['evol_dist'],
+                            10) == 0.0
+
+    def test_streamed_inodes(self):
+        from pinfer import build_itree
+        from pinfer.itree import iter_inodes
+
+        iTree = build_itree(self.gTree)
+
+        # every inode must arrive after its parent, with the same edges as the full iTree
+        seen = {}
+        for inode, parent, evol_dist in iter_inodes(self.gTree):
+            assert inode not in seen
+            assert parent is None or parent in seen
+            seen[inode] = (parent, evol_dist)
+
+        assert sorted(seen) == sorted(iTree.nodes())
+        assert [n for n in seen if seen[n][0] is None] == \
+            [n for n in iTree.nodes() if not iTree.predecessors(n)]
+
+        for s, t in iTree.edges():
+            assert seen[t][0] == s
+            assert np.round(seen[t][1] - iTree.edge[s][t]['evol_dist'], 10) == 0.0
+
+    def test_parallel_iTree(self):
+        from pinfer import build_itree
+
+        serial   = build_itree(self.gTree, compact=True)
+        parallel = build_itree(self.gTree, compact=True, workers=2)
+
+        # the process pool must give exactly the same iTree, in the same order
+        for attribute in ['gene_a', 'gene_b', 'species', 'parent', 't_birth', 't_death']:
+            assert (getattr(serial, attribute) == getattr(parallel, attribute)).all()
+        assert np.allclose(serial.evol_dist, parallel.evol_dist, equal_nan=True)
+
+    def test_incremental_update(self):
+        from pinfer import build_itree
+        from pinfer.itree import update_itree
+
+        gTree = self.gTree
+        iTree = build_itree(gTree)
+
+        def assert_rebuilt(iTree):
+            rebuilt = build_itree(gTree)
+            assert sorted(iTree.nodes()) == sorted(rebuilt.nodes())
+            assert sorted(iTree.edges()) == sorted(rebuilt.edges())
+            for node in rebuilt.nodes():
+                assert iTree.node[node] == rebuilt.node[node]
+            for s, t in rebuilt.edges():
+                assert np.round(iTree.edge[s][t]['evol_dist'] - rebuilt.edge[s][t]['evol_dist'],
+                                10) == 0.0
+
+        leaf   = [n for n in gTree.nodes() if gTree.node[n]['name'] == 'n10470'][0]
+        leaf   = [n for n in nx.descendants(gTree, leaf) if not gTree.successors(n)][0]
+        parent = gTree.predecessors(leaf)[0]
+
+        # a new sibling for an existing leaf
+        update_itree(iTree, gTree, added=[(parent, 'new_gene', 0.25,
+                                           {'S': gTree.node[leaf]['S'], 'D': 'N'})])
+        assert_rebuilt(iTree)
+
+        # a changed branch distance
+        update_itree(iTree, gTree, distances={(parent, leaf): 2.0})
+        assert_rebuilt(iTree)
+
+        # and finally the new leaf is removed again
+        update_itree(iTree, gTree, removed=['new_gene'])
+        assert_rebuilt(iTree)
+
+        # a new child for a leaf, which may move the times of every gene, and back again
+        leaf = [n for n in gTree.nodes()
+                if not gTree.successors(n) and 'lost' not in gTree.node[n]['name'].lower()][0]
+        update_itree(iTree, gTree, added=[(leaf, 'new_child', 0.5,
+                                           {'S': gTree.node[leaf]['S'], 'D': 'N'})])
+        assert_rebuilt(iTree)
+
+        update_itree(iTree, gTree, removed=['new_child'])
+        assert_rebuilt(iTree)
+
+    def test_sub_iTree(self):
+        from pinfer import build_itree
+
+        gTree = self.gTree
+        iTree = build_itree(gTree)
+
+        genes = [n for n in gTree.nodes() if not gTree.successors(n)][::20]
+
+        subTree = build_itree(gTree, genes=genes)
+
+        # every inode must be exactly as within the full iTree, including its parent
+        assert len(subTree.nodes()) < len(iTree.nodes())
+        for node in subTree.nodes():
+            assert subTree.node[node] == iTree.node[node]
+            assert subTree.predecessors(node) == iTree.predecessors(node)
+        for s, t in subTree.edges():
+            assert subTree.edge[s][t] == iTree.edge[s][t]
+
+        # and every interaction between the requested genes must be present
+        for node in iTree.nodes():
+            geneA, geneB = node.split('-')
+            if geneA in genes and geneB in genes:
+                assert node in subTree
+
+    def test_iTree_estimate(self):
+        from pinfer import build_itree
+        from pinfer.itree import estimate_itree
+
+        compact  = build_itree(self.gTree, compact=True)
+        estimate = estimate_itree(self.gTree, compact=True)
+
+        # the counts must be exact, for every species
+        for code, species in enumerate(compact.species_names):
+            inodes = compact.species == code
+            assert estimate[species]['inodes'] == inodes.sum()
+            assert estimate[species]['edges'] == (compact.parent[inodes] >= 0).sum()
+
+        assert sum(e['nbytes'] for e in estimate.values()) == compact.nbytes
+
+        # a networkx iTree takes far more memory than the compact arrays
+        default = estimate_itree(self.gTree)
+        for species in estimate:
+            assert default[species]['inodes'] == estimate[species]['inodes']
+            assert default[species]['nbytes'] > 10 * estimate[species]['nbytes']
+
+    def test_paralog_collapse(self):
+        from pinfer import build_itree
+        from pinfer.itree import collapse_paralogs, expand_beliefs
+
+        gTree = self.gTree
+        iTree = build_itree(gTree)
+
+        collapsed, members = collapse_paralogs(gTree, 0.1)
+
+        assert members
+        assert len(collapsed.nodes()) < len(gTree.nodes())
+
+        cTree = build_itree(collapsed)
+        assert len(cTree.nodes()) < len(iTree.nodes())
+
+        for i, node in enumerate(cTree.nodes()):
+            cTree.node[node]['belief'] = np.array([i, 1.0])
+
+        beliefs = expand_beliefs(cTree, collapsed, members)
+
+        # every expanded interaction must exist within the full iTree
+        assert set(beliefs) <= set(iTree.nodes())
+
+        # and interactions between collapsed paralogs take the belief of their representative
+        for representative, leaves in members.items():
+            inode = '%s-%s' % (representative, representative)
+            for leafA in leaves:
+                for leafB in leaves:
+                    pair = '-'.join(sorted([leafA, leafB]))
+                    assert (beliefs[pair] == cTree.node[inode]['belief']).all()
+
+    def test_interned_ids(self):
+        from pinfer import build_itree
+        from pinfer.itree.utils import SymbolTable, pack_pair, pack_pairs, unpack_pairs
+
+        table = SymbolTable(['b', 'a', 'b', 'c'])
+        assert table.names == ['b', 'a', 'c']
+        assert list(table.lookup(['c', 'x', 'b', 'c'])) == [2, -1, 0, 2]
+
+        # pair keys must not depend on the order of the genes
+        a = np.array([0, 5, 7, 2 ** 31 - 1])
+        b = np.array([3, 5, 1, 0])
+        keys = pack_pairs(a, b)
+        assert list(keys) == [pack_pair(int(i), int(j)) for i, j in zip(b, a)]
+        assert [tuple(pair) for pair in np.transpose(unpack_pairs(keys))] == \
+            [tuple(sorted(pair)) for pair in zip(a, b)]
+
+        compact = build_itree(self.gTree, compact=True)
+
+        # every interaction must be found from its genes, in either order
+        ids = np.arange(len(compact))
+        assert (compact.find_inodes(compact.gene_a, compact.gene_b) == ids).all()
+        assert (compact.find_inodes(compact.gene_b, compact.gene_a) == ids).all()
+        assert compact.inode_id('XBP11_Hs', 'ATF62_Hs') == \
+            compact.inode_keys().index('ATF62_Hs-XBP11_Hs')
+        assert compact.inode_id('XBP11_Hs', '131584_Ci') == -1
+
     def test_basic_iTree_run(self):
         from pinfer import build_itree
 
@@ -134,6 +134,26 @@ def cancer_example(analyse_function):
     assert (np.round(cancer.node['H']['belief'], 3) == np.array([0.353, 0.647])).all()
 
 
+def get_random_tree(n_nodes, seed, branching=None):
+
+    # a random tree of two-state nodes, with random CPTs
+    # each node is attached to a random earlier node, or if branching is given, nodes are
+    # attached in order such that every parent has branching children
+    np.random.seed(seed)
+
+    tree = nx.DiGraph()
+    tree.add_node(0, prior=np.array([0.4, 0.6]))
+    for child in range(1, n_nodes):
+        if branching is None:
+            tree.add_edge(np.random.randint(child), child)
+        else:
+            tree.add_edge((child - 1) // branching, child)
+        p_gain, p_loss = np.random.uniform(0.01, 0.5, size=2)
+        tree.node[child]['CPT'] = np.array([[1 - p_gain, p_gain], [p_loss, 1 - p_loss]])
+
+    return tree
+
+
 from pinfer.infer import analyse_polytree
 
 
@@ -145,6 +165,230 @@ class TestPolytree(unittest.TestCase):
     def test_sprinkler(self):
         sprinkler_example(analyse_polytree)
 
+    def test_tree_pivot(self):
+
+        # a tree-shaped network, observed at two leaves, analysed either from
+        # an automatically found pivot or from the root, must give the same beliefs
+        def get_tree():
+            tree = nx.DiGraph()
+            tree.add_node('A', prior=np.array([0.3, 0.7]))
+            for parent, child in [('A', 'B'), ('A', 'C'), ('B', 'D'), ('B', 'E'), ('C', 'F')]:
+                tree.add_edge(parent, child)
+                tree.node[child]['CPT'] = np.array([[0.9, 0.1], [0.25, 0.75]])
+            tree.node['D']['observation'] = np.array([0., 1.])
+            tree.node['E']['observation'] = np.array([1., 0.])
+            return tree
+
+        found = analyse_polytree(get_tree())
+        rooted = analyse_polytree(get_tree(), pivot_node='A')
+
+        for node in found.nodes():
+            assert (np.round(found.node[node]['belief'] - rooted.node[node]['belief'],
+                             10) == 0.0).all()
+
+    def test_polytree_pivot(self):
+        from pinfer.infer.polytree import _steiner_nodes
+
+        # the change set spans the paths between the observations, through multiple parents
+        sprinkler = get_sprinkler()
+        assert _steiner_nodes(sprinkler, ['H']) == set(['H'])
+        assert _steiner_nodes(sprinkler, ['W', 'H']) == set(['W', 'R', 'H'])
+        assert _steiner_nodes(sprinkler, ['W', 'S']) == set(['W', 'R', 'H', 'S'])
+
+        def get_observed():
+            sprinkler = get_sprinkler()
+            sprinkler.node['W']['observation'] = np.array([0., 1.])
+            sprinkler.node['S']['observation'] = np.array([1., 0.])
+            return sprinkler
+
+        found = analyse_polytree(get_observed())
+        rooted = analyse_polytree(get_observed(), pivot_node='R')
+
+        for node in found.nodes():
+            assert (np.round(found.node[node]['belief'] - rooted.node[node]['belief'],
+                             10) == 0.0).all()
+
+    def test_chain_contraction(self):
+        from pinfer.infer import contract_chains, recover_beliefs
+
+        # a tree with long pass-through chains, observed below each of them
+        def get_tree():
+            tree = nx.DiGraph()
+            tree.add_node('A', prior=np.array([0.3, 0.7]))
+            edges = [('A', 'B'), ('B', 'C'), ('C', 'D'), ('D', 'E'), ('D', 'F'),
+                     ('A', 'G'), ('G', 'H'), ('H', 'I')]
+            for i, (parent, child) in enumerate(edges):
+                tree.add_edge(parent, child)
+                tree.node[child]['CPT'] = np.array([[0.9 - 0.05 * i, 0.1 + 0.05 * i],
+                                                    [0.25, 0.75]])
+            tree.node['E']['observation'] = np.array([0., 1.])
+            tree.node['I']['observation'] = np.array([1., 0.])
+            return tree
+
+        full = analyse_polytree(get_tree())
+
+        tree = get_tree()
+        contracted, chains = contract_chains(tree)
+
+        assert sorted(contracted.nodes()) == ['A', 'D', 'E', 'F', 'I']
+        assert sorted(chains['D']['interior']) == ['B', 'C']
+
+        analyse_polytree(contracted)
+        recover_beliefs(tree, contracted, chains)
+
+        for node in full.nodes():
+            assert (np.round(full.node[node]['belief'] - tree.node[node]['belief'],
+                             10) == 0.0).all()
+
+    def test_vectorised_engine(self):
+        from pinfer.infer import analyse_tree
+
+        # a random tree, with random CPTs and scattered observations
+        def get_tree():
+            tree = get_random_tree(300, 0)
+            for node in np.random.choice(300, size=30, replace=False):
+                tree.node[node]['observation'] = np.random.uniform(size=2)
+            return tree
+
+        expected = analyse_polytree(get_tree(), pivot_node=0)
+        tree = analyse_tree(get_tree())
+
+        for node in tree.nodes():
+            for key in ['belief', 'causal', 'diagnostic']:
+                assert np.allclose(tree.node[node][key], expected.node[node][key])
+            assert 'observation' not in tree.node[node]
+        for s, t in tree.edges():
+            for key in ['causal', 'diagnostic']:
+                assert np.allclose(tree.edge[s][t][key], expected.edge[s][t][key])
+
+    def test_compiled_plan(self):
+        from pinfer.infer import compile_polytree
+
+        # the plan must follow each new set of evidence, as analyse_polytree does
+        def run_plan(sprinkler):
+            plan = compile_polytree(sprinkler)
+            plan.run(tree=sprinkler)
+        sprinkler_example(run_plan)
+
+        # networks with (undirected) cycles are refused, as by analyse_polytree
+        self.assertRaises(Exception, compile_polytree, get_cancer())
+        self.assertRaises(Exception, analyse_polytree, get_cancer())
+
+        # a single plan, run repeatedly with new CPTs and evidence on the same structure
+        def get_tree(seed):
+            tree = get_random_tree(100, seed, branching=3)
+            for node in np.random.choice(100, size=10, replace=False):
+                tree.node[node]['observation'] = np.random.uniform(size=2)
+            return tree
+
+        plan = compile_polytree(get_tree(0))
+        for seed in range(3):
+            tree = get_tree(seed)
+            beliefs = plan.run(evidence=dict((n, tree.node[n]['observation']) for n in tree
+                                             if 'observation' in tree.node[n]),
+                               CPTs=dict((n, tree.node[n]['CPT']) for n in tree if n != 0))
+            expected = analyse_polytree(tree)
+            for node in tree.nodes():
+                assert np.allclose(beliefs[node], expected.node[node]['belief'])
+
+        # a tree written back by a run with overrides holds the evidence and CPTs it used,
+        # so it can then be updated lazily by analyse_polytree
+        for log_space in [False, True]:
+            tree = get_random_tree(50, 2)
+            tree.node[10]['observation'] = np.array([0.2, 0.8])
+            CPT = np.array([[0.6, 0.4], [0.3, 0.7]])
+
+            plan = compile_polytree(tree)
+            plan.run(evidence={20: np.array([0.9, 0.1])}, CPTs={10: CPT}, priors={0: [0.5, 0.5]},
+                     tree=tree, log_space=log_space)
+            assert 'evidence' not in tree.node[10]
+            assert (tree.node[10]['CPT'] == CPT).all()
+
+            tree.node[30]['observation'] = np.array([0.7, 0.3])
+            analyse_polytree(tree)
+
+            expected = get_random_tree(50, 2)
+            expected.node[10]['CPT'] = CPT
+            expected.node[0]['prior'] = np.array([0.5, 0.5])
+            expected.node[20]['observation'] = np.array([0.9, 0.1])
+            expected.node[30]['observation'] = np.array([0.7, 0.3])
+            analyse_polytree(expected)
+            for node in tree.nodes():
+                assert np.allclose(tree.node[node]['belief'], expected.node[node]['belief'])
+
+    def test_log_space(self):
+        from itertools import product
+        from pinfer.infer import compile_polytree
+
+        def run_log(sprinkler):
+            compile_polytree(sprinkler).run(tree=sprinkler, log_space=True)
+        sprinkler_example(run_log)
+
+        # the log likelihood must match that found by summing over all joint states
+        sprinkler = get_sprinkler()
+        evidence = {'H': np.array([0., 1.]), 'W': np.array([0.3, 0.9])}
+        likelihood = 0.0
+        for r, s, w, h in product([0, 1], repeat=4):
+            likelihood += (sprinkler.node['R']['prior'][r] * sprinkler.node['S']['prior'][s] *
+                           sprinkler.node['W']['CPT'][r, w] * sprinkler.node['H']['CPT'][r, s, h] *
+                           evidence['W'][w] * evidence['H'][h])
+
+        plan = compile_polytree(sprinkler)
+        assert np.isclose(plan.log_likelihood(evidence=evidence), np.log(likelihood))
+        plan.run(evidence=evidence, tree=sprinkler, log_space=True)
+        assert np.isclose(sprinkler.graph['log_likelihood'], np.log(likelihood))
+
+        # a very deep chain, with evidence along its length, whose likelihood underflows
+        chain = nx.DiGraph()
+        chain.add_node(0, prior=np.array([0.5, 0.5]))
+        for node in range(1, 5000):
+            chain.add_edge(node - 1, node)
+            chain.node[node]['CPT'] = np.array([[0.9, 0.1], [0.1, 0.9]])
+            chain.node[node]['observation'] = np.array([0.001, 0.002])
+
+        plan = compile_polytree(chain)
+        beliefs = plan.run(log_space=True)
+        expected = plan.run()
+        for node in chain.nodes():
+            assert np.allclose(beliefs[node], expected[node])
+        assert np.isfinite(plan.log_likelihood())
+        assert plan.log_likelihood() < np.log(np.finfo(float).tiny)
+
+    def test_incremental_evidence(self):
+
+        # observations arriving one at a time, pushed out incrementally, must give the
+        # same beliefs as a full update
+        def get_tree():
+            return analyse_polytree(get_random_tree(200, 1))
+
+        full, exact, approx, queried = get_tree(), get_tree(), get_tree(), get_tree()
+        for node in [150, 20, 199, 7, 64]:
+            beliefs = dict((n, approx.node[n]['belief']) for n in approx.nodes())
+            for tree in [full, exact, approx, queried]:
+                tree.node[node]['observation'] = np.array([0.2, 0.8])
+            analyse_polytree(full)
+            analyse_polytree(exact, tolerance=0.0)
+            analyse_polytree(approx, tolerance=1e-3)
+            analyse_polytree(queried, query=[3, node - 1])
+
+            for n in full.nodes():
+                assert np.allclose(exact.node[n]['belief'], full.node[n]['belief'])
+
+            # with a looser tolerance, the update must stop short of some nodes (whose
+            # beliefs are left as they were) while staying within ten times the tolerance
+            assert any(approx.node[n]['belief'] is beliefs[n] for n in approx.nodes())
+            for n in full.nodes():
+                assert np.abs(approx.node[n]['belief'] - full.node[n]['belief']).max() < 1e-2
+            for n in [3, node - 1]:
+                assert np.allclose(queried.node[n]['belief'], full.node[n]['belief'])
+
+        # nodes left behind by the queries are brought up to date by a full update
+        assert queried.graph['pending']
+        analyse_polytree(queried)
+        assert 'pending' not in queried.graph
+        for n in full.nodes():
+            assert np.allclose(queried.node[n]['belief'], full.node[n]['belief'])
+
     def tearDown(self):
         pass
 